@@ -0,0 +1,169 @@
+# Integrity manifests for downloaded images, and a content-addressed archive
+# of them.
+#
+# A manifest ([ID]_[start].manifest, next to the .bin) lists the image in
+# CHUNK_SIZE pieces, each with its offset, length, CRC32 and SHA-256, plus the
+# ranges that passed the logger's CRC when they were read. Checking an image
+# against it finds the damaged chunks without going back to the logger.
+#
+# The archive keeps every chunk once, under its SHA-256
+# (data/archive/objects/ab/abcd...), and every download as a copy of its
+# manifest (data/archive/manifests/). Downloading the same session again, or
+# appending to it, only adds the chunks that changed. Chunks are aligned to
+# the start of flash, so everything but the last, partly written one stays
+# the same as a session grows. Each object is checked once, however many
+# downloads share it.
+#
+#   python archive.py                       check the whole archive
+#   python archive.py FILE.bin              check FILE.bin against its manifest
+#   python archive.py FILE.manifest OUT.bin rebuild an image from the archive
+#
+# MESHLAB, UH Manoa
+import json, logging, sys, time, hashlib, binascii, threading
+from os import makedirs, replace, listdir, getpid
+from os.path import join, exists, basename, getsize
+
+
+# One erase sector
+CHUNK_SIZE = 4096
+ARCHIVE_DIR = join('data', 'archive')
+
+
+logger = logging.getLogger(__name__)
+
+
+def manifest_name(fn_bin):
+    return fn_bin.rsplit('.', 1)[0] + '.manifest'
+
+def _write(fn, data):
+    # write-then-rename so a crash never leaves a half-written file. Several
+    # downloads can be storing the same chunk at once (read_all.py), each
+    # through a file of its own.
+    tmp = '{}.{}.{}.tmp'.format(fn, getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    replace(tmp, fn)
+
+def _chunks(fn_bin, chunk_size):
+    with open(fn_bin, 'rb') as f:
+        offset = 0
+        while True:
+            b = f.read(chunk_size)
+            if not len(b):
+                break
+            yield offset, b
+            offset += len(b)
+
+def make_manifest(fn_bin, *_, chunk_size=CHUNK_SIZE, verified=None):
+    """Manifest of fn_bin. verified: the ranges ([begin, end], byte offsets
+    into the image) whose CRC was checked as they were read, if known."""
+    C = []
+    for offset, b in _chunks(fn_bin, chunk_size):
+        C.append([offset, len(b), binascii.crc32(b), hashlib.sha256(b).hexdigest()])
+    return {'image':basename(fn_bin),
+            'size':getsize(fn_bin),
+            'chunk_size':chunk_size,
+            'time':time.time(),
+            'verified':verified if verified is not None else [],
+            'chunks':C}
+
+def save_manifest(fn, manifest):
+    _write(fn, json.dumps(manifest, separators=(',', ':')).encode())
+
+def load_manifest(fn):
+    return json.load(open(fn))
+
+def verify_image(fn_bin, manifest):
+    """Offsets of the chunks of fn_bin that don't match manifest (by CRC32).
+    Empty if the image is intact."""
+    bad = []
+    C = {c[0]:c for c in manifest['chunks']}
+    for offset, b in _chunks(fn_bin, manifest['chunk_size']):
+        c = C.pop(offset, None)
+        if c is None or c[1] != len(b) or c[2] != binascii.crc32(b):
+            bad.append(offset)
+    # chunks the file is missing altogether
+    bad.extend(sorted(C))
+    return bad
+
+def _object_name(digest, root):
+    return join(root, 'objects', digest[:2], digest)
+
+def store(fn_bin, manifest, *_, root=ARCHIVE_DIR):
+    """Put fn_bin in the archive: the chunks it doesn't have yet, and a copy
+    of manifest. Returns (number of new chunks, bytes added)."""
+    makedirs(join(root, 'manifests'), exist_ok=True)
+    n, byte_count = 0, 0
+    with open(fn_bin, 'rb') as f:
+        for offset, length, crc, digest in manifest['chunks']:
+            fn = _object_name(digest, root)
+            if exists(fn):
+                continue
+            f.seek(offset)
+            b = f.read(length)
+            if hashlib.sha256(b).hexdigest() != digest:
+                raise ValueError('{} changed at {:X} since its manifest was made'.format(fn_bin, offset))
+            makedirs(join(root, 'objects', digest[:2]), exist_ok=True)
+            _write(fn, b)
+            n += 1
+            byte_count += length
+    stem = manifest['image'].rsplit('.', 1)[0]
+    save_manifest(join(root, 'manifests', '{}_{}.manifest'.format(stem, int(manifest['time']))), manifest)
+    logger.debug('{}: {} new chunk(s), {:,} byte'.format(fn_bin, n, byte_count))
+    return n, byte_count
+
+def restore(manifest, fn_out, *_, root=ARCHIVE_DIR):
+    """Rebuild the image described by manifest from the archive into
+    fn_out."""
+    with open(fn_out, 'wb') as f:
+        for offset, length, crc, digest in manifest['chunks']:
+            b = open(_object_name(digest, root), 'rb').read()
+            if len(b) != length or binascii.crc32(b) != crc:
+                raise ValueError('Archived chunk {} is damaged'.format(digest))
+            f.seek(offset)
+            f.write(b)
+
+def verify_archive(*_, root=ARCHIVE_DIR):
+    """Check every chunk of every archived download, each chunk only once.
+    Returns {manifest file name: [offsets of missing or damaged chunks]}
+    for the downloads that can't be restored."""
+    good, bad = set(), set()
+    R = {}
+    d = join(root, 'manifests')
+    for fn in sorted(listdir(d)) if exists(d) else []:
+        if not fn.endswith('.manifest'):
+            continue
+        for offset, length, crc, digest in load_manifest(join(d, fn))['chunks']:
+            if digest not in good and digest not in bad:
+                try:
+                    b = open(_object_name(digest, root), 'rb').read()
+                except OSError:
+                    b = None
+                if b is not None and len(b) == length and binascii.crc32(b) == crc:
+                    good.add(digest)
+                else:
+                    bad.add(digest)
+            if digest in bad:
+                R.setdefault(fn, []).append(offset)
+    logger.debug('{} chunk(s) checked, {} bad'.format(len(good) + len(bad), len(bad)))
+    return R
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.WARNING)
+
+    if 1 == len(sys.argv):
+        R = verify_archive()
+        for fn in sorted(R):
+            print('{}: {} chunk(s) missing or damaged'.format(fn, len(R[fn])))
+        print('Archive is intact.' if not len(R) else 'Archive is damaged.')
+    elif 2 == len(sys.argv):
+        fn_bin = sys.argv[1]
+        bad = verify_image(fn_bin, load_manifest(manifest_name(fn_bin)))
+        for offset in bad:
+            print('Chunk at {:X} does not match.'.format(offset))
+        print('{} is intact.'.format(fn_bin) if not len(bad) else '{} is damaged.'.format(fn_bin))
+    else:
+        restore(load_manifest(sys.argv[1]), sys.argv[2])
+        print('Output binary file: {}'.format(sys.argv[2]))
@@ -0,0 +1,328 @@
+# asyncio version of Kiwi, for talking to many loggers (or to a logger while
+# doing something else) from one thread.
+#
+# Same methods as Kiwi, as coroutines, v0 and v1 firmware alike. Every
+# method takes an optional timeout (in second) that bounds the whole call;
+# running out of time raises asyncio.TimeoutError like asyncio.wait_for().
+# A call that is cancelled or times out halfway leaves the link in an
+# unknown state, so the next call discards whatever arrives late first.
+#
+# Needs pyserial-asyncio for AsyncKiwi.open(). Anything that gives asyncio
+# streams will do otherwise.
+#
+# MESHLAB, UH Manoa
+import asyncio, json, logging, struct, time
+from kiwi import Kiwi, is_erased, parse_config_v0, parse_config_v1, parse_is_logging_v0, parse_is_logging_v1, \
+     parse_battery_v0, parse_battery_v1, parse_float, parse_light_v0, parse_light_v1, check_range_response
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncKiwi:
+
+    # per-read timeouts, same as what Kiwi gets from Serial(timeout=1) and
+    # from read_range_core()
+    LINE_TIMEOUT = 1
+    RANGE_TIMEOUT = 4
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._lock = asyncio.Lock()
+        self._dirty = False
+        self._version = None
+        self._config = None
+
+    @classmethod
+    async def open(cls, port, *_, baudrate=115200, timeout=None):
+        """Open port and identify the logger on it."""
+        if serial_asyncio is None:
+            raise RuntimeError('AsyncKiwi.open() needs pyserial-asyncio (pip install pyserial-asyncio)')
+        reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+        kiwi = cls(reader, writer)
+        try:
+            await kiwi.connect(timeout=timeout)
+        except:
+            writer.close()
+            raise
+        return kiwi
+
+    def close(self):
+        self._writer.close()
+
+    async def connect(self, *_, timeout=None):
+        await self.identify_version(timeout=timeout)
+        logger.debug('Version={}'.format(self._version))
+        await self.get_config(timeout=timeout)
+        logger.debug(self._config)
+
+        self.sample_struct_fmt = 'ffHHHHHH' if self._config['use_light'] else 'ff'
+        self.SAMPLE_SIZE_BYTE = struct.calcsize(self.sample_struct_fmt)
+        self.SAMPLE_PER_PAGE = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE//self.SAMPLE_SIZE_BYTE
+
+    # - - - plumbing - - -
+
+    async def _call(self, coro, timeout):
+        """Run coro with the link to itself, within timeout."""
+        async with self._lock:
+            if self._dirty:
+                await self._discard_input()
+            try:
+                return await asyncio.wait_for(coro, timeout)
+            except BaseException:
+                # cancelled, timed out or failed: its response may still be
+                # on its way.
+                self._dirty = True
+                raise
+
+    async def _discard_input(self):
+        while True:
+            try:
+                r = await asyncio.wait_for(self._reader.read(4096), 0.05)
+            except asyncio.TimeoutError:
+                break
+            if not len(r):
+                break
+        self._dirty = False
+
+    async def _write(self, data):
+        self._writer.write(data)
+        await self._writer.drain()
+
+    async def _readline(self, timeout=LINE_TIMEOUT):
+        """A line, or b'' on timeout (like Serial.readline())."""
+        try:
+            return await asyncio.wait_for(self._reader.readline(), timeout)
+        except asyncio.TimeoutError:
+            self._dirty = True
+            return b''
+
+    async def _read(self, n, timeout):
+        """Up to n bytes, fewer on timeout (like Serial.read())."""
+        D = bytearray()
+        deadline = time.time() + timeout
+        while len(D) < n:
+            try:
+                r = await asyncio.wait_for(self._reader.read(n - len(D)), max(0, deadline - time.time()))
+            except asyncio.TimeoutError:
+                self._dirty = True
+                break
+            if not len(r):
+                break
+            D.extend(r)
+        return bytes(D)
+
+    # - - - protocol - - -
+
+    async def identify_version(self, *_, timeout=None):
+        return await self._call(self._identify_version(), timeout)
+
+    async def _identify_version(self):
+        try:
+            await self._write(b'id')
+            r = await self._readline()
+            logger.debug(r)
+            d = json.loads(r.decode().strip())
+            self._version = d['ver']
+            return self._version
+        except (UnicodeDecodeError, IndexError, TypeError, ValueError):
+            pass
+
+        try:
+            await self._write(b'is_logging')
+            r = await self._readline()
+            logger.debug(r)
+            if 3 == len(r.decode().strip().split(',')):
+                self._version = 0
+                return self._version
+        except (UnicodeDecodeError, IndexError, TypeError, ValueError):
+            pass
+
+        return self._version
+
+    async def get_config(self, *_, use_cached=False, timeout=None):
+        if use_cached and self._config is not None:
+            return self._config
+        return await self._call(self._get_config(), timeout)
+
+    async def _get_config(self):
+        if 0 == self._version:
+            R = []
+            for cmd in [b'get_logging_config', b'get_logger_name', b'spi_flash_get_unique_id']:
+                await self._write(cmd)
+                R.append(await self._readline())
+                logger.debug(R[-1])
+                if not len(R[0]):
+                    # no response; don't bother with the rest
+                    return None
+            config = parse_config_v0(*R)
+        else:
+            R = []
+            for cmd in [b'get_config', b'id']:
+                await self._write(cmd)
+                R.append(await self._readline())
+                logger.debug(R[-1])
+            config = parse_config_v1(*R)
+        self._config = config
+        return self._config
+
+    async def is_logging(self, *_, timeout=None):
+        return await self._call(self._is_logging(), timeout)
+
+    async def _is_logging(self):
+        if 0 == self._version:
+            await self._write(b'is_logging')
+            r = await self._readline()
+            logger.debug(r)
+            return parse_is_logging_v0(r)
+        await self._write(b'status')
+        r = await self._readline()
+        logger.debug(r)
+        return parse_is_logging_v1(r)
+
+    async def get_battery_voltage(self, *_, timeout=None):
+        return await self._call(self._get_battery_voltage(), timeout)
+
+    async def _get_battery_voltage(self):
+        if 0 == self._version:
+            await self._write(b'read_sys_volt')
+            r = await self._readline()
+            logger.debug(r)
+            return parse_battery_v0(r)
+        await self._write(b'status')
+        r = await self._readline()
+        logger.debug(r)
+        return parse_battery_v1(r)
+
+    async def read_range_core(self, begin, end, *_, timeout=None):
+        return await self._call(self._read_range_core(begin, end), timeout)
+
+    async def _read_range_core(self, begin, end):
+        assert end >= begin
+
+        expected_length = end - begin + 1 + 4
+
+        if 0 == self._version:
+            cmd = 'spi_flash_read_range{:x},{:x}\n'.format(begin, end)
+        else:
+            cmd = 'read_range{:x},{:x}\n'.format(begin, end)
+        await self._write(cmd.encode())
+        line = await self._read(expected_length, self.RANGE_TIMEOUT)
+        error = check_range_response(line, expected_length)
+        if 'short' == error:
+            logger.error('Expecting {}, got {}.'.format(expected_length, len(line)))
+            return []
+        if 'crc' == error:
+            logger.error('CRC failure')
+            self._dirty = True
+            return []
+
+        return line[:-4]    # strip CRC32
+
+    async def read_page(self, page, *_, timeout=None):
+        begin = page*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        end = (page+1)*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1
+        return await self.read_range_core(begin, end, timeout=timeout)
+
+    async def find_last_used_page(self, *_, timeout=None):
+        """The deadline covers the whole search, not each page read."""
+        return await asyncio.wait_for(self._find_last_used_page(), timeout)
+
+    async def _find_last_used_page(self):
+        begin, end = 0, Kiwi.SPI_FLASH_SIZE_BYTE//Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        while end - begin > 1:
+            mid = (end + begin)//2
+            if is_erased(await self.read_page(mid)):
+                end = mid
+            else:
+                begin = mid
+        if not is_erased(await self.read_page(begin)):
+            return begin
+        return None
+
+    async def read_temperature(self, *_, timeout=None):
+        return await self._call(self._read_float(b'read_temperature' if 0 == self._version else b'T', 'Deg.C'), timeout)
+
+    async def read_pressure(self, *_, timeout=None):
+        return await self._call(self._read_float(b'read_pressure' if 0 == self._version else b'P', 'kPa'), timeout)
+
+    async def _read_float(self, cmd, unit):
+        await self._write(cmd)
+        r = await self._readline()
+        logger.debug(r)
+        return parse_float(r, unit)
+
+    async def read_light(self, *_, as_dict=True, timeout=None):
+        """in lx for all"""
+        return await self._call(self._read_light(as_dict), timeout)
+
+    async def _read_light(self, as_dict):
+        if 0 == self._version:
+            R = []
+            for cmd in [b'read_ambient_lx', b'read_white_lx', b'read_rgbw']:
+                await self._write(cmd)
+                R.append(await self._readline())
+                logger.debug(R[-1])
+            d = parse_light_v0(*R)
+        else:
+            await self._write(b'L')
+            r = await self._readline()
+            logger.debug(r)
+            d = parse_light_v1(r)
+
+        return dict(zip(('hdr_als', 'hdr_w', 'r', 'g', 'b', 'w'), d)) if as_dict else d
+
+    async def start_logging(self, *_, timeout=None):
+        await self._call(self._start_logging(), timeout)
+        await asyncio.sleep(0.2)
+        return await self.is_logging(timeout=timeout)
+
+    async def _start_logging(self):
+        if 0 == self._version:
+            await self._write(b'start_logging')
+        else:
+            await self._write(b'rt0')
+            await self._readline()  # "OK\r\n"
+            await self._write('start_logging{}\n'.format(int(time.time())).encode('utf-8'))
+            await self._readline()  # "OK\r\n"
+
+    async def stop_logging(self, *_, timeout=None):
+        return await self._call(self._stop_logging(), timeout)
+
+    async def _stop_logging(self):
+        await self._write(b'stop_logging')
+        if 0 != self._version:
+            await self._readline()
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.WARNING)
+
+    async def show(port):
+        kiwi = await AsyncKiwi.open(port, timeout=10)
+        try:
+            config = await kiwi.get_config(use_cached=True)
+            print('{}: "{}" (ID={}); battery: {:.1f} V; {}.'.format(
+                port,
+                config['name'],
+                config['id'],
+                await kiwi.get_battery_voltage(timeout=2),
+                'LOGGING' if await kiwi.is_logging(timeout=2) else 'not logging'))
+        finally:
+            kiwi.close()
+
+    async def main(ports):
+        R = await asyncio.gather(*[show(port) for port in ports], return_exceptions=True)
+        for port, r in zip(ports, R):
+            if isinstance(r, Exception):
+                print('{}: {}'.format(port, r or type(r).__name__))
+
+    from common import serial_port_best_guess2
+    asyncio.run(main(serial_port_best_guess2()))
@@ -68,21 +68,28 @@ def bin2csv(fn_bin, fn_csv, config):
     with open(fn_bin, 'rb') as fin:
         while True:
             page = fin.read(Kiwi.SPI_FLASH_PAGE_SIZE_BYTE)
-            if len(page) < Kiwi.SPI_FLASH_PAGE_SIZE_BYTE:
+            if not len(page):
                 break
 
-            L = list(range(0, Kiwi.SPI_FLASH_PAGE_SIZE_BYTE, 4+4+2+2+2+2+2+2 if config['use_light'] else 4+4))
-            for a,b in list(zip(L[::], L[1::])):
+            # the last page may be partial if read_memory() trimmed it. Every
+            # whole sample in the page counts, the last one too: 32 per page
+            # without light (this used to drop the 32nd), 10 with it.
+            size = 4+4+2+2+2+2+2+2 if config['use_light'] else 4+4
+            L = list(range(0, len(page) - size + 1, size))
+            for a,b in [(a, a + size) for a in L]:
                 d = struct.unpack('ffHHHHHH' if config['use_light'] else 'ff', page[a:b])
                 if any([math.isnan(dd) for dd in d]):
                     break
                 D.append(d)
 
     logging.debug('Reconstructing time axis...')
+    # a partial download (read_time_window()) doesn't begin at the first sample
+    offset = config.get('sample_offset', 0)
     if 'logging_start_time' in config and 'logging_interval_code' in config:
-        ts = construct_timestamp(config['logging_start_time'], len(D), SAMPLE_INTERVAL_CODE_MAP[config['logging_interval_code']])
+        interval = SAMPLE_INTERVAL_CODE_MAP[config['logging_interval_code']]
+        ts = construct_timestamp(config['logging_start_time'] + offset*interval, len(D), interval)
     else:
-        ts = construct_timestamp(config['start'], len(D), config['interval_ms']*1e-3)
+        ts = construct_timestamp(config['start'] + offset*config['interval_ms']*1e-3, len(D), config['interval_ms']*1e-3)
     dt = [ts2dt(tmp) for tmp in ts]
     tmp = list(zip(*D))
     tmp.insert(0, ts)
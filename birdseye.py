@@ -9,6 +9,8 @@ from matplotlib.dates import DateFormatter
 
 def birdseye_read(kiwi, downsample_N):
     config = kiwi.get_config(use_cached=True)
+    # keep the pages read for the next overview and the download
+    kiwi.enable_page_store()
     sample_count = kiwi.get_sample_count()
     #if sample_count <= 0:
     #    return None,None
@@ -36,10 +38,8 @@ def birdseye_read(kiwi, downsample_N):
 
             if current_page_index != page_i:
                 logging.debug('Reading logger...')
-                begin = page_i*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
-                end = (page_i+1)*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1
-                current_page = kiwi.read_range_core(begin, end)
-                if len(current_page) != end - begin + 1:
+                current_page = kiwi.read_page(page_i)
+                if len(current_page) != Kiwi.SPI_FLASH_PAGE_SIZE_BYTE:
                     logging.warning('Invalid response length. Skipping sample {}'.format(sample_index))
                     continue
                 current_page_index = page_i
@@ -18,7 +18,7 @@ import serial.tools.list_ports
 from dev.crc_check import check_response
 from datetime import datetime
 from os.path import exists, join, dirname
-import platform, glob, json
+import platform, glob, json, threading
 
 
 SAMPLE_INTERVAL_CODE_MAP = {0:1/5, 1:1, 2:60}
@@ -26,6 +26,10 @@ SAMPLE_INTERVAL_CODE_MAP = {0:1/5, 1:1, 2:60}
 SPI_FLASH_SIZE_BYTE = 16*1024*1024
 SPI_FLASH_PAGE_SIZE_BYTE = 256
 
+# identity.tmp is read and written from several threads when probing many
+# ports at once
+_identity_lock = threading.Lock()
+
 
 class InvalidResponseException(Exception):
     pass
@@ -116,6 +120,7 @@ def serial_port_best_guess2():
             L.extend(filter(lambda x: '.' in x, glob.glob('/dev/*usbmodem*')))
             L.extend(glob.glob('/dev/*usbserial*'))
             L.extend(glob.glob('/dev/ttyUSB*'))             # mac, or pi with adapter
+            L.extend(glob.glob('/dev/ttyACM*'))             # linux, native USB
             L.extend(glob.glob('/dev/ttyS0'))               # the horror
 
     if hint in L:
@@ -150,6 +155,51 @@ def save_most_recent_id(logger_id):
     config['most_recent_id'] = logger_id
     json.dump(config, open(fn, 'w'))
 
+def load_identity(port):
+    """What Kiwi remembers about the logger last seen on port: its id,
+    firmware version and sample layout. None if nothing."""
+    try:
+        fn = join(dirname(__file__), 'identity.tmp')
+        with _identity_lock:
+            if exists(fn):
+                return json.load(open(fn)).get(port, None)
+    except Exception as e:
+        logging.debug(e)
+    return None
+
+def save_identity(port, identity):
+    fn = join(dirname(__file__), 'identity.tmp')
+    with _identity_lock:
+        try:
+            config = json.load(open(fn)) if exists(fn) else {}
+        except ValueError:
+            config = {}
+        config[port] = identity
+        with open(fn, 'w') as f:
+            json.dump(config, f)
+
+def load_link_profile(version):
+    """What dev/comm_link_stress_test.py measured for loggers running
+    firmware version: {'rx_budget', 'chunk_size', 'pipeline_depth', ...}.
+    None if it hasn't been run for that version."""
+    try:
+        fn = join(dirname(__file__), 'link_profile.json')
+        if exists(fn):
+            return json.load(open(fn)).get(str(version), None)
+    except Exception as e:
+        logging.debug(e)
+    return None
+
+def save_link_profile(version, profile):
+    fn = join(dirname(__file__), 'link_profile.json')
+    try:
+        config = json.load(open(fn)) if exists(fn) else {}
+    except ValueError:
+        config = {}
+    config[str(version)] = profile
+    with open(fn, 'w') as f:
+        json.dump(config, f, indent=2)
+
 
 if '__main__' == __name__:
     
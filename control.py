@@ -28,7 +28,7 @@ with Serial(PORT, 115200, timeout=1) as ser:
 def get_name(ent):
     logging.debug('get_name')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, kiwi.get_config(use_cached=True)['name'])
@@ -37,7 +37,7 @@ def get_name(ent):
 def get_id(ent):
     logging.debug('get_id')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, kiwi.get_config(use_cached=True)['id'])
@@ -46,7 +46,7 @@ def get_id(ent):
 def read_battery_voltage(ent):
     logging.debug('get_vbatt')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, '{} V'.format(kiwi.get_battery_voltage()))
@@ -55,7 +55,7 @@ def read_battery_voltage(ent):
 def read_clock(ent):
     logging.debug('read_clock')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, '{}'.format(ts2dt(kiwi.read_rtc())))
@@ -64,13 +64,13 @@ def read_clock(ent):
 def set_clock(ent):
     logging.debug('set_clock')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         kiwi.set_rtc()
 
 def read_temperature(ent):
     logging.debug('read_temperature')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, '{} \u2103'.format(kiwi.read_temperature()))
@@ -79,7 +79,7 @@ def read_temperature(ent):
 def read_pressure(ent):
     logging.debug('read_pressure')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         v = ser.readline().decode().strip()
@@ -89,7 +89,7 @@ def read_pressure(ent):
 def read_ambient_lx(ent):
     logging.debug('read_ambient_lx')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         ent.insert(0, '{} lux'.format(kiwi.read_light()['hdr_als']))
@@ -98,7 +98,7 @@ def read_ambient_lx(ent):
 def read_rgbw(ent):
     logging.debug('read_rgbw')
     with Serial(PORT, 115200, timeout=1) as ser:
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, lazy=True)
         ent.config(state='normal')
         ent.delete(0, tk.END)
         r = kiwi.read_light()
@@ -172,7 +172,7 @@ class App:
     def set_clock(self):
         logging.debug('set_rtc')
         with Serial(PORT, 115200, timeout=1) as ser:
-            kiwi = Kiwi(ser)
+            kiwi = Kiwi(ser, lazy=True)
             kiwi.set_rtc()
             self.label1.set(kiwi.read_rtc())
 
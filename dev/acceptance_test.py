@@ -76,12 +76,12 @@ with Serial(PORT, 115200, timeout=1) as ser:
             C = ['red', 'green', 'blue']
             good = True
             for k,c in enumerate(C):
-                ser.write('{}_led_on'.format(c).encode())
-                ser.write('{}on'.format(c[0]).encode())
+                kiwi.send('{}_led_on'.format(c).encode())
+                kiwi.send('{}on'.format(c[0]).encode())
                 time.sleep(0.1)
                 a = kiwi.read_light(as_dict=False)[k + 2]
-                ser.write('{}_led_off'.format(c).encode())
-                ser.write('{}off'.format(c[0]).encode())
+                kiwi.send('{}_led_off'.format(c).encode())
+                kiwi.send('{}off'.format(c[0]).encode())
                 time.sleep(0.1)
                 b = kiwi.read_light(as_dict=False)[k + 2]
                 good &= a > 1.1*b
@@ -93,15 +93,15 @@ with Serial(PORT, 115200, timeout=1) as ser:
 
     def f():
         try:
-            ser.write(b'red_led_on ron')
-            ser.write(b'green_led_on gon')
-            ser.write(b'blue_led_on bon')
+            kiwi.send(b'red_led_on ron')
+            kiwi.send(b'green_led_on gon')
+            kiwi.send(b'blue_led_on bon')
             time.sleep(0.1)
             a = kiwi.read_light(as_dict=False)[0]
 
-            ser.write(b'red_led_off roff')
-            ser.write(b'green_led_off goff')
-            ser.write(b'blue_led_off boff')
+            kiwi.send(b'red_led_off roff')
+            kiwi.send(b'green_led_off goff')
+            kiwi.send(b'blue_led_off boff')
             time.sleep(0.1)
             b = kiwi.read_light(as_dict=False)[0]
 
@@ -0,0 +1,431 @@
+# Record a session with a logger, and play it back later without one.
+#
+# Recorder wraps a serial.Serial and writes every byte sent and received, with
+# timestamps, to a capture file. Replay is a serial.Serial look-alike that
+# feeds a capture back to unmodified Kiwi code, at the recorded speed, faster,
+# or as fast as it can be read. The responses to read_range come back exactly
+# as recorded, CRCs included, so downloads and parsing can be timed and
+# compared from one change to the next on a machine with no logger attached.
+#
+# In-process:
+#   kiwi = Kiwi(Recorder(Serial(PORT, 115200, timeout=1), 'session.cap'))
+#   kiwi = Kiwi(Replay('session.cap', speed=None))
+#
+# For scripts that open the port by name (read_memory.py, birdseye.py...),
+# both are served on a pseudo-terminal (POSIX only); give the script the path
+# it prints:
+#   python -m dev.capture record PORT session.cap
+#   python -m dev.capture replay session.cap [SPEED]    (0: no waiting)
+#   python -m dev.capture info session.cap
+#
+# The replay only holds as long as the code asks the same things it asked
+# when recording. Where it doesn't, Replay skips ahead to the next matching
+# command if there is one, and says so.
+#
+# MESHLAB, UH Manoa
+import sys, os, json, logging, struct, threading, time
+sys.path.append('..')
+from kiwi import Kiwi, LinkTimer
+from common import load_identity, save_identity
+
+
+logger = logging.getLogger(__name__)
+
+
+MAGIC = b'KIWICAP1'
+# seconds since the start, what happened, number of bytes that follow
+_EVENT = struct.Struct('<dcI')
+WRITE = b'W'        # sent to the logger
+READ = b'R'         # received from the logger
+RESET = b'F'        # reset_input_buffer()
+
+
+class Recorder:
+    """A serial.Serial that also writes everything to path. port is the name
+    the code being recorded knows the port by (default: ser.port)."""
+
+    def __init__(self, ser, path, *_, port=None):
+        self._ser = ser
+        self._port = ser.port if port is None else port
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._t0 = time.time()
+        # what Kiwi knew about the port when it started, so that the replay
+        # takes the same path through the handshake
+        header = {'port':self._port,
+                  'time':self._t0,
+                  'baudrate':getattr(ser, 'baudrate', None),
+                  'identity':load_identity(self._port),
+                  'version':Kiwi._links.get(self._port, {}).get('version')}
+        header = json.dumps(header).encode()
+        self._file.write(MAGIC + struct.pack('<I', len(header)) + header)
+
+    def _log(self, kind, data=b''):
+        with self._lock:
+            self._file.write(_EVENT.pack(time.time() - self._t0, kind, len(data)))
+            self._file.write(data)
+
+    @property
+    def port(self):
+        return self._port
+
+    @property
+    def timeout(self):
+        return self._ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self._ser.timeout = value
+
+    def write(self, data):
+        self._log(WRITE, bytes(data))
+        return self._ser.write(data)
+
+    def read(self, size=1):
+        r = self._ser.read(size)
+        if len(r):
+            self._log(READ, r)
+        return r
+
+    def readinto(self, b):
+        n = self._ser.readinto(b)
+        if n:
+            self._log(READ, bytes(memoryview(b).cast('B')[:n]))
+        return n
+
+    def readline(self):
+        r = self._ser.readline()
+        if len(r):
+            self._log(READ, r)
+        return r
+
+    def reset_input_buffer(self):
+        self._log(RESET)
+        self._ser.reset_input_buffer()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        self._ser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def __getattr__(self, name):
+        # in_waiting, flushOutput, reset_output_buffer...
+        return getattr(self._ser, name)
+
+
+def load(path):
+    """(header, [(t, kind, data), ...]) from a capture file."""
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if not buf.startswith(MAGIC):
+        raise ValueError('{} is not a capture file'.format(path))
+    i = len(MAGIC)
+    n, = struct.unpack_from('<I', buf, i)
+    i += 4
+    header = json.loads(buf[i:i + n].decode())
+    i += n
+    events = []
+    while i + _EVENT.size <= len(buf):
+        t, kind, n = _EVENT.unpack_from(buf, i)
+        i += _EVENT.size
+        events.append((t, kind, buf[i:i + n]))
+        i += n
+    return header, events
+
+
+class Replay:
+    """A serial.Serial look-alike that plays back a capture.
+
+    speed: 1 replays the recorded timing, 10 ten times faster, None without
+    waiting at all (reads that timed out in the recording return at once).
+
+    The port name, 'replay://' and the capture's path by default, gets the
+    identity the recording started with, in identity.tmp and Kiwi._links,
+    and Kiwi takes the time from clock(), so that it asks the same things
+    it did when recording."""
+
+    def __init__(self, path, *_, speed=1, port=None, timeout=1):
+        self._header, self._events = load(path)
+        self.speed = speed
+        self.timeout = timeout
+        self.port = 'replay://{}'.format(os.path.abspath(path)) if port is None else port
+        self.baudrate = self._header.get('baudrate')
+        self.is_open = True
+        save_identity(self.port, self._header.get('identity'))
+        version = self._header.get('version')
+        if version is None:
+            Kiwi._links.pop(self.port, None)
+        else:
+            Kiwi._links[self.port] = {'version':version,
+                                      'timer':LinkTimer((self.baudrate or 115200)/10)}
+
+        self._lock = threading.RLock()
+        self._host = 0          # next WRITE or RESET to be matched
+        self._wpos = 0          # bytes of that WRITE matched so far
+        self._read = 0          # next READ to hand out...
+        self._rpos = 0          # ...and how much of it has been already
+        # (recorded time, wall time) of the last command sent; responses
+        # are timed from there
+        self._anchor = (0, time.time())
+        self.diverged = 0
+
+    # - - - matching the host's side - - -
+
+    def _next_write(self, start):
+        for i in range(start, len(self._events)):
+            if WRITE == self._events[i][1]:
+                return i
+        return len(self._events)
+
+    def _find(self, data):
+        """The next WRITE that starts with data (or that data starts with)."""
+        for i in range(self._host, len(self._events)):
+            _, kind, d = self._events[i]
+            if WRITE == kind and d[:len(data)] == data[:len(d)]:
+                return i
+        return None
+
+    def write(self, data):
+        data = bytes(data)
+        with self._lock:
+            rest = data
+            while len(rest):
+                # (a reset that didn't happen this time is harmless)
+                i = self._host
+                while i < len(self._events) and WRITE != self._events[i][1]:
+                    i += 1
+                expected = self._events[i][2][self._wpos:] if i < len(self._events) else b''
+                n = min(len(rest), len(expected))
+                if 0 == n or rest[:n] != expected[:n]:
+                    j = self._find(rest)
+                    if j is None:
+                        logger.warning('Not in the capture: {}'.format(rest[:64]))
+                        break
+                    logger.warning('Replay diverged; skipping to event {}'.format(j))
+                    self.diverged += 1
+                    self._host, self._wpos = j, 0
+                    # what the skipped commands got back isn't for this one
+                    if self._read < j:
+                        self._read, self._rpos = j, 0
+                    continue
+                if 0 == self._wpos:
+                    self._anchor = (self._events[i][0], time.time())
+                self._host = i
+                self._wpos += n
+                rest = rest[n:]
+                if self._wpos >= len(self._events[i][2]):
+                    self._host, self._wpos = i + 1, 0
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._lock:
+            # drop what was received before the recorded reset, if there is
+            # one before the next command
+            i = self._host
+            while i < len(self._events) and READ == self._events[i][1]:
+                i += 1
+            if i < len(self._events) and RESET == self._events[i][1] and 0 == self._wpos:
+                self._host = i + 1
+                if self._read < i:
+                    self._read, self._rpos = i, 0
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def reset_output_buffer(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def clock(self):
+        """The time it was when the capture was at this point, for Kiwi to
+        use instead of time.time()."""
+        t0, wall = self._anchor
+        return self._header['time'] + t0 + (time.time() - wall)*(self.speed or 0)
+
+    # - - - the logger's side - - -
+
+    def _due(self, t):
+        """Wall time when something recorded at t is received."""
+        t0, wall = self._anchor
+        if self.speed is None or t <= t0:
+            return wall
+        return wall + (t - t0)/self.speed
+
+    def _available(self, now):
+        """(bytes that can be read by now, wall time when more will be or
+        None if not until the next command)"""
+        limit = self._next_write(self._host)
+        if self._wpos > 0:
+            limit = self._host
+        n = 0
+        for i in range(self._read, limit):
+            t, kind, d = self._events[i]
+            if READ != kind:
+                continue
+            due = self._due(t)
+            if due > now:
+                return n, due
+            n += len(d) - (self._rpos if i == self._read else 0)
+        return n, None
+
+    def _take(self, n, line=False):
+        out = bytearray()
+        while len(out) < n and self._read < len(self._events):
+            t, kind, d = self._events[self._read]
+            if READ != kind:
+                # n is no more than _available() said, so this was sent
+                self._read, self._rpos = self._read + 1, 0
+                continue
+            k = min(n - len(out), len(d) - self._rpos)
+            if line:
+                nl = d.find(b'\n', self._rpos, self._rpos + k)
+                if nl >= 0:
+                    k = nl + 1 - self._rpos
+            out.extend(d[self._rpos:self._rpos + k])
+            self._rpos += k
+            if self._rpos >= len(d):
+                self._read, self._rpos = self._read + 1, 0
+            if line and out.endswith(b'\n'):
+                break
+        return out
+
+    def _receive(self, n, *_, line=False):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        out = bytearray()
+        while len(out) < n:
+            with self._lock:
+                now = time.time()
+                m, more_at = self._available(now)
+                if m:
+                    out.extend(self._take(min(m, n - len(out)), line=line))
+                    if line and out.endswith(b'\n'):
+                        break
+                    continue
+            if more_at is None and self.speed is None:
+                # the recorded read timed out here too
+                break
+            if deadline is not None and now >= deadline:
+                break
+            wait = 0.01 if more_at is None else more_at - now
+            if deadline is not None:
+                wait = min(wait, deadline - now)
+            time.sleep(max(0, min(wait, 0.01)))
+        return bytes(out)
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            return self._available(time.time())[0]
+
+    def read(self, size=1):
+        return self._receive(size)
+
+    def readinto(self, b):
+        m = memoryview(b).cast('B')
+        r = self.read(len(m))
+        m[:len(r)] = r
+        return len(r)
+
+    def readline(self):
+        return self._receive(sys.maxsize, line=True)
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+
+def open_pty():
+    """(fd of the master side, path of the slave side for serial.Serial())"""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, os.ttyname(slave)
+
+def serve_pty(master, dev):
+    """Shuttle bytes between the master side of a pty and dev (anything
+    with write() and read()) until the pty is closed. The threads are
+    daemons."""
+    def host2dev():
+        while True:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                return
+            dev.write(data)
+
+    def dev2host():
+        while True:
+            try:
+                data = dev.read(4096)
+            except OSError:
+                return
+            if not len(data):
+                # a Replay without waiting returns at once
+                time.sleep(0.001)
+                continue
+            try:
+                os.write(master, data)
+            except OSError:
+                return
+
+    for f in (host2dev, dev2host):
+        threading.Thread(target=f, daemon=True).start()
+
+def info(path):
+    header, events = load(path)
+    print(json.dumps(header, indent=2))
+    if not len(events):
+        return
+    for kind, name in ((WRITE, 'sent'), (READ, 'received')):
+        E = [d for _, k, d in events if k == kind]
+        print('{}: {} byte(s) in {} chunk(s)'.format(name, sum(len(d) for d in E), len(E)))
+    print('{:.2f} s'.format(events[-1][0]))
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.INFO)
+
+    cmd = sys.argv[1] if len(sys.argv) > 1 else None
+    if 'info' == cmd and len(sys.argv) > 2:
+        info(sys.argv[2])
+    elif cmd in ['record', 'replay'] and len(sys.argv) > 2:
+        from serial import Serial
+
+        master, path = open_pty()
+        if 'record' == cmd:
+            dev = Recorder(Serial(sys.argv[2], 115200, timeout=0.01), sys.argv[3], port=path)
+        else:
+            speed = float(sys.argv[3]) if len(sys.argv) > 3 else 1
+            dev = Replay(sys.argv[2], speed=speed or None, port=path, timeout=0.01)
+        serve_pty(master, dev)
+        print('{} on {}. Ctrl+C to stop.'.format('Recording' if 'record' == cmd else 'Replaying', path))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            dev.close()
+    else:
+        print('python -m dev.capture record PORT FILE | replay FILE [SPEED] | info FILE')
@@ -1,48 +1,238 @@
-import sys, logging, time, json
+# Characterize the link to a logger: how long commands take to come back, how
+# fast read_range goes per chunk size and pipeline depth, how much can be sent
+# to it before it starts losing input, and how long it takes to recover when
+# it does.
+#
+# The firmware doesn't read its input while it's busy sending a response, so
+# commands sent behind a long read_range pile up in its RX buffer. Past some
+# size, some of them are lost without a word. Found by hand to be somewhere
+# around 763~782 bytes on v0; find_rx_limit() does the search, and
+# suggest_budget() turns it into a safe budget.
+#
+# The results are printed, and saved as the profile for the logger's firmware
+# version in link_profile.json (see common.load_link_profile()), where Kiwi
+# and read_memory.py pick them up.
+#
+#   python -m dev.comm_link_stress_test [PORT]
+#
+# MESHLAB, UH Manoa
+import sys, logging, time, json, statistics
+sys.path.append('..')
 from serial import Serial
+from kiwi import Kiwi
+from common import serial_port_best_guess, save_link_profile
 
 
+# Read this much to keep the logger busy while the filler goes in: ~5.7 s at
+# 115200 baud, plenty to write a few kB.
+BUSY_BYTE = 64*1024
+# Largest filler tried
+MAX_FILLER_BYTE = 4096
+# A size only counts as safe if it works this many times in a row
+REPEAT = 3
+# Keep this fraction of the measured limit as the budget
+SAFETY_MARGIN = 2/3
+# Round trips timed per command
+LATENCY_REPEAT = 20
+# read_range sizes tried, and how much is read at each
+CHUNK_SIZES = [1024, 4096, 8192, 16384, 32768]
+PIPELINE_DEPTHS = [1, 2, 4, 8]
+THROUGHPUT_BYTE = 32*1024
+# Take the smallest chunk size / depth that gets within this fraction of the
+# best throughput: smaller chunks lose less to a CRC failure, and fewer
+# requests in flight lose less to a reset
+GOOD_ENOUGH = 0.95
 
-PORT = 'COM18'
 
+logger = logging.getLogger(__name__)
 
-with Serial(PORT, 115200, timeout=1) as ser:
+
+def flood(ser, *_, repeat=200):
+    """The original experiment: send every v0 query back to back, repeat times
+    over, and print whatever comes back. Lost commands show up as missing or
+    garbled responses."""
     s = 'read_temperature read_pressure read_ambient_lx read_white_lx read_rgbw get_logger_name spi_flash_get_unique_id read_rtc_time read_sys_volt get_logging_config is_logging\n'
     s = s.split(' ')
-    for i in range(200):
+    for i in range(repeat):
         for cmd in s:
             ser.write(cmd.encode())
-            #for ss in cmd:
-            #    ser.write(ss.encode())
-                #print(ss, end='')
-                #time.sleep(0.00001)
-        
+
     while True:
         r = ser.read()
-        if len(r):
-            try:
-                print(r.decode(), end='')
-            except UnicodeDecodeError:
-                logging.error(r)
+        if not len(r):
+            break
+        try:
+            print(r.decode(), end='')
+        except UnicodeDecodeError:
+            logging.error(r)
+
+def _ping(kiwi):
+    """A command that answers in one line, and a check of its response."""
+    if 0 == kiwi._version:
+        return b'is_logging', lambda r: 3 == len(r.split(b','))
+    return b'id', lambda r: b'"ver"' in r
+
+def _overflow(kiwi, n):
+    """Send n bytes of filler and then a command while the logger is busy.
+    True if the command got through."""
+    ser = kiwi._ser
+    cmd, ok = _ping(kiwi)
+
+    kiwi._flush()
+    old_timeout = ser.timeout
+    ser.timeout = 2*BUSY_BYTE*10/115200 + 1
+    try:
+        ser.write(kiwi._read_range_cmd(0, BUSY_BYTE - 1))
+        # it's busy once the response starts coming
+        ser.read(1)
+        # whitespace, so that nothing in the filler gets a response of its own
+        ser.write(b' '*n + cmd)
+        ser.read(BUSY_BYTE + 4 - 1)
+        ser.timeout = 1
+        return ok(ser.readline())
+    finally:
+        ser.timeout = old_timeout
+
+def probe(kiwi, n):
+    """True if a command still gets through when it arrives behind n bytes of
+    filler, all sent while the logger is busy."""
+    try:
+        return _overflow(kiwi, n)
+    finally:
+        # a logger that lost input takes a while to recover
+        time.sleep(0.5)
+        kiwi._drain()
+
+def recovery_time(kiwi, n, *_, timeout=5):
+    """Seconds from losing input (to n bytes of filler) until the logger
+    answers again. 0 if nothing was lost; None if it didn't answer within
+    timeout."""
+    if _overflow(kiwi, n):
+        kiwi._drain()
+        return 0
+    ser = kiwi._ser
+    cmd, ok = _ping(kiwi)
+    old_timeout = ser.timeout
+    ser.timeout = 0.1
+    t0 = time.time()
+    try:
+        while time.time() - t0 < timeout:
+            ser.reset_input_buffer()
+            ser.write(cmd)
+            if ok(ser.readline()):
+                return time.time() - t0
+        return None
+    finally:
+        ser.timeout = old_timeout
+        kiwi._drain()
+
+def latency(kiwi, *_, repeat=LATENCY_REPEAT):
+    """Round trip time of the short commands, {command: {'median', 'max'}}
+    in second."""
+    if 0 == kiwi._version:
+        C = [b'is_logging', b'read_sys_volt', b'read_temperature']
+    else:
+        C = [b'id', b'status', b'T']
+    ser = kiwi._ser
+    R = {}
+    for cmd in C:
+        T = []
+        for _ in range(repeat):
+            kiwi._flush()
+            t = time.time()
+            ser.write(cmd)
+            if ser.readline().endswith(b'\n'):
+                T.append(time.time() - t)
+        if len(T):
+            R[cmd.decode()] = {'median':statistics.median(T), 'max':max(T)}
+    return R
+
+def throughput(kiwi, chunk_size, *_, depth=1, total=THROUGHPUT_BYTE):
+    """byte/s reading total bytes in chunk_size pieces, depth of them in
+    flight. None if any failed."""
+    ranges = [(a, a + chunk_size - 1) for a in range(0, max(total, chunk_size), chunk_size)]
+    t = time.time()
+    for _, _, line in kiwi.read_range_pipelined(ranges, depth=depth):
+        if line is None:
+            return None
+    return len(ranges)*chunk_size/(time.time() - t)
+
+def pick(rates):
+    """The smallest key whose rate is within GOOD_ENOUGH of the best."""
+    rates = {k:v for k, v in rates.items() if v is not None}
+    if not len(rates):
+        return None
+    best = max(rates.values())
+    return min(k for k, v in rates.items() if v >= GOOD_ENOUGH*best)
+
+def find_rx_limit(kiwi, *_, lo=0, hi=MAX_FILLER_BYTE, repeat=REPEAT):
+    """The most unread command bytes (filler plus the probe command) the
+    logger takes without losing any, to within a byte. Binary search between
+    lo (known good) and hi (known bad) bytes of filler. None if even lo
+    fails."""
+    probe_len = 2 if kiwi._version else len(b'is_logging')
+    if not all(probe(kiwi, lo) for _ in range(repeat)):
+        return None
+    if all(probe(kiwi, hi) for _ in range(repeat)):
+        logger.warning('No loss even with {} byte(s)'.format(hi + probe_len))
+        return hi + probe_len
+    while hi - lo > 1:
+        mid = (lo + hi)//2
+        good = all(probe(kiwi, mid) for _ in range(repeat))
+        logger.info('{} byte(s): {}'.format(mid + probe_len, 'OK' if good else 'LOST'))
+        if good:
+            lo = mid
+        else:
+            hi = mid
+    return lo + probe_len
+
+def suggest_budget(limit):
+    return int(limit*SAFETY_MARGIN)//16*16
+
+def characterize(kiwi, *_, chunk_sizes=CHUNK_SIZES, depths=PIPELINE_DEPTHS, total=THROUGHPUT_BYTE):
+    """Measure everything; returns the profile."""
+    config = kiwi.get_config(use_cached=True)
+    profile = {'version':kiwi._version,
+               'id':config['id'],
+               'port':getattr(kiwi._ser, 'port', None),
+               'time':time.time()}
 
-sys.exit()
+    logger.info('Latency...')
+    profile['latency'] = latency(kiwi)
 
+    logger.info('Throughput...')
+    # one at a time first, so that the chunk size is judged on its own
+    rates = {size:throughput(kiwi, size, total=total) for size in chunk_sizes}
+    logger.info(rates)
+    profile['throughput'] = {str(k):v for k, v in rates.items()}
+    profile['chunk_size'] = pick(rates) or chunk_sizes[0]
+    rates = {depth:throughput(kiwi, profile['chunk_size'], depth=depth, total=total) for depth in depths}
+    logger.info(rates)
+    profile['pipelined_throughput'] = {str(k):v for k, v in rates.items()}
+    profile['pipeline_depth'] = pick(rates) or 1
 
+    logger.info('RX buffer...')
+    limit = find_rx_limit(kiwi)
+    profile['rx_limit'] = limit
+    if limit is not None:
+        profile['rx_budget'] = suggest_budget(limit)
+        profile['recovery_time'] = recovery_time(kiwi, limit + 64)
+    return profile
 
-with Serial(PORT, 115200, timeout=1) as ser:
 
-    # 625~1250
-    # 625~938
-    # 625~782
-    # 704~782
-    # 743~782
-    # 763~782 (763, can recover)
-    # 773~782 (773, can recover)
-    # 782 takes a while to recover
+if '__main__' == __name__:
 
-    ser.write(('gibberish'*1000).encode())
+    logging.basicConfig(level=logging.INFO)
 
-    #while True:
-    #    ser.write(b'red_led_off red_led_on')
+    PORT = sys.argv[1] if len(sys.argv) > 1 else serial_port_best_guess(prompt=True)
 
-print('done.')
+    with Serial(PORT, 115200, timeout=1) as ser:
+        kiwi = Kiwi(ser)
+        profile = characterize(kiwi)
+        print(json.dumps(profile, indent=2))
+        if profile['rx_limit'] is None:
+            print('Logger isn\'t answering even with nothing queued up. Not saved.')
+        else:
+            save_link_profile(kiwi._version, profile)
+            print('Saved as the profile for firmware v{} (RX budget {} byte(s), was {}).'.format(
+                kiwi._version, profile['rx_budget'], Kiwi.RX_BUFFER_BUDGET_BYTE.get(kiwi._version)))
@@ -0,0 +1,381 @@
+# A simulated logger, for exercising Kiwi and the download scripts without
+# hardware.
+#
+# SimulatedLogger is a file-like stand-in for serial.Serial: pass it to
+# Kiwi() in place of a real port. It speaks the v0 or the v1 command set
+# (whatever kiwi.py sends), keeps a 16 MB flash image, and can be told to
+# misbehave: pace output at a baud rate, add latency, drop bytes, corrupt
+# CRCs, and lose input past an RX buffer limit the way the real firmware
+# does (see dev/comm_link_stress_test.py).
+#
+# serve_pty() exposes one on a pseudo-terminal so unmodified scripts can
+# open it by name (POSIX only):
+#   python -m dev.simulator [VERSION [SAMPLE_COUNT [BAUDRATE]]]
+#
+# Every random fault comes from one seeded generator, so a run with the same
+# settings and the same commands misbehaves the same way.
+#
+# MESHLAB, UH Manoa
+import binascii, json, logging, random, struct, threading, time
+
+
+logger = logging.getLogger(__name__)
+
+
+SPI_FLASH_SIZE_BYTE = 16*1024*1024
+SPI_FLASH_PAGE_SIZE_BYTE = 256
+
+
+class SimulatedLogger:
+
+    def __init__(self, *_, version=1, logger_id='E4616C64AB123456', name='sim',
+                 use_light=True, interval_ms=1000, start=None, sample_count=0,
+                 is_logging=False, baudrate=None, latency=0, drop_rate=0, crc_error_rate=0,
+                 rx_buffer_size=None, seed=0, timeout=1):
+        self.version = version
+        self.id = logger_id
+        self.name = name
+        self.use_light = use_light
+        self.interval_ms = interval_ms
+        self.start = int(time.time()) - sample_count*interval_ms//1000 if start is None else start
+        self.stop = None
+        # while logging, a sample is added every interval_ms
+        self.logging = is_logging
+        self.vbatt = 3.05
+
+        # fault injection and pacing
+        self.baudrate = baudrate
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.crc_error_rate = crc_error_rate
+        self.rx_buffer_size = rx_buffer_size
+        self._random = random.Random(seed)
+
+        # serial.Serial look-alike
+        self.port = 'sim://{}'.format(logger_id)
+        self.timeout = timeout
+        self.is_open = True
+
+        self.flash = bytearray(b'\xff'*SPI_FLASH_SIZE_BYTE)
+        self._rx = bytearray()
+        self._tx = bytearray()
+        self._tx_ready = 0      # time when the first byte in _tx may be read
+        self.commands = []      # every command parsed, for inspection
+        self.lost_byte_count = 0
+        self._lock = threading.RLock()
+
+        self.fill(sample_count)
+
+    # - - - flash content - - -
+
+    @property
+    def sample_struct_fmt(self):
+        return 'ffHHHHHH' if self.use_light else 'ff'
+
+    @property
+    def sample_size(self):
+        return struct.calcsize(self.sample_struct_fmt)
+
+    @property
+    def sample_per_page(self):
+        return SPI_FLASH_PAGE_SIZE_BYTE//self.sample_size
+
+    def fill(self, sample_count, *_, first=0):
+        """Write samples [first, first + sample_count) to flash, the way the
+        firmware lays them out (whole samples per page, the rest left
+        erased)."""
+        sample_count = min(sample_count, self.capacity - first)
+        for i in range(first, first + sample_count):
+            page, k = divmod(i, self.sample_per_page)
+            addr = page*SPI_FLASH_PAGE_SIZE_BYTE + k*self.sample_size
+            t = 20 + (i % 1000)/100
+            p = 101.325 + (i % 37)/100
+            if self.use_light:
+                d = struct.pack(self.sample_struct_fmt, t, p, i % 65536, 2, 3, 4, 5, 6)
+            else:
+                d = struct.pack(self.sample_struct_fmt, t, p)
+            self.flash[addr:addr + len(d)] = d
+        self._sample_count = first + sample_count
+
+    @property
+    def capacity(self):
+        return SPI_FLASH_SIZE_BYTE//SPI_FLASH_PAGE_SIZE_BYTE*self.sample_per_page
+
+    @property
+    def sample_count(self):
+        return self._sample_count
+
+    def advance(self, n=1):
+        """Pretend the logger took n more samples."""
+        self.fill(n, first=self._sample_count)
+
+    def _catch_up(self):
+        # the samples it would have taken since the last command
+        if self.logging:
+            n = int((time.time() - self.start)*1000//self.interval_ms) + 1
+            if n > self._sample_count:
+                self.advance(n - self._sample_count)
+
+    # - - - serial.Serial interface - - -
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            return len(self._tx) if time.time() >= self._tx_ready else 0
+
+    def write(self, data):
+        data = bytes(data)
+        with self._lock:
+            if self.rx_buffer_size is not None:
+                room = max(0, self.rx_buffer_size - len(self._rx))
+                if len(data) > room:
+                    self.lost_byte_count += len(data) - room
+                    data = data[:room]
+            self._rx.extend(data)
+            self._process()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flushOutput(self):
+        pass
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._tx.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def _take(self, n, deadline):
+        """Wait for up to n bytes until deadline."""
+        out = bytearray()
+        while len(out) < n:
+            with self._lock:
+                self._process()
+                now = time.time()
+                if now >= self._tx_ready and len(self._tx):
+                    k = len(self._tx)
+                    if self.baudrate:
+                        # bytes that made it over the wire by now (10 bits each)
+                        k = min(k, int((now - self._tx_ready)*self.baudrate/10))
+                    k = min(k, n - len(out))
+                    if k > 0:
+                        out.extend(self._tx[:k])
+                        del self._tx[:k]
+                        if self.baudrate:
+                            self._tx_ready += k*10/self.baudrate
+                        continue
+            if deadline is not None and time.time() >= deadline:
+                break
+            time.sleep(0.0005)
+        return bytes(out)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        return self._take(size, deadline)
+
+    def readinto(self, b):
+        m = memoryview(b).cast('B')
+        r = self.read(len(m))
+        m[:len(r)] = r
+        return len(r)
+
+    def readline(self):
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        out = bytearray()
+        while True:
+            c = self._take(1, deadline)
+            if not len(c):
+                break
+            out.extend(c)
+            if c == b'\n':
+                break
+        return bytes(out)
+
+    # - - - firmware - - -
+
+    def _send(self, data):
+        data = bytearray(data)
+        if self.drop_rate:
+            data = bytearray(b for b in data if self._random.random() >= self.drop_rate)
+        if not len(self._tx):
+            self._tx_ready = max(self._tx_ready, time.time() + self.latency)
+        self._tx.extend(data)
+
+    def _line(self, s):
+        self._send((s + '\r\n').encode())
+
+    def _crc(self, data):
+        crc = binascii.crc32(data)
+        if self.crc_error_rate and self._random.random() < self.crc_error_rate:
+            crc ^= 1
+        return struct.pack('<I', crc)
+
+    # commands that take arguments, terminated by '\n' (or '\r\n')
+    _V1_ARG = ['read_range', 'start_logging', 'set_logging_interval', 'set_logger_name']
+    _V0_ARG = ['spi_flash_read_range', 'set_logging_interval', 'set_logger_name', 'write_rtc']
+    _V1_PLAIN = ['get_config', 'status', 'id', 'rt0', 'stop_logging', 'start_logging',
+                 'enable_light_sensors', 'disable_light_sensors', 'clear_memory', 'reset',
+                 'red_led_on', 'red_led_off', 'green_led_on', 'green_led_off', 'blue_led_on', 'blue_led_off',
+                 'ron', 'roff', 'gon', 'goff', 'bon', 'boff', 'T', 'P', 'L']
+    _V0_PLAIN = ['get_logging_config', 'get_logger_name', 'spi_flash_get_unique_id', 'is_logging',
+                 'read_sys_volt', 'read_temperature', 'read_pressure', 'read_ambient_lx',
+                 'read_white_lx', 'read_rgbw', 'read_rtc', 'start_logging', 'stop_logging', 'clear_memory',
+                 'red_led_on', 'red_led_off', 'green_led_on', 'green_led_off', 'blue_led_on', 'blue_led_off']
+
+    def _busy(self):
+        # The firmware doesn't look at its input while it's still sending a
+        # response, so with a baud rate set, commands queue up (and can
+        # overflow the RX buffer) behind a long read_range.
+        if not self.baudrate or not len(self._tx):
+            return False
+        return time.time() < self._tx_ready + len(self._tx)*10/self.baudrate
+
+    def _process(self):
+        arg = self._V1_ARG if self.version else self._V0_ARG
+        plain = sorted(self._V1_PLAIN if self.version else self._V0_PLAIN, key=len, reverse=True)
+        while not self._busy():
+            s = self._rx.lstrip(b' \r\n\t')
+            del self._rx[:len(self._rx) - len(s)]
+            if not len(self._rx):
+                return
+            text = self._rx.decode(errors='replace')
+
+            for name in arg:
+                if text.startswith(name):
+                    rest = text[len(name):]
+                    if '\n' not in rest:
+                        if not len(rest) or rest[0] in '0123456789abcdef,-':
+                            return      # wait for the rest of it
+                        continue        # e.g. "start_logging" without argument
+                    a = rest.split('\n', 1)[0].strip()
+                    del self._rx[:len(name) + len(rest.split('\n', 1)[0]) + 1]
+                    self.commands.append(name)
+                    self._run(name, a)
+                    break
+            else:
+                for name in plain:
+                    if text.startswith(name):
+                        del self._rx[:len(name)]
+                        self.commands.append(name)
+                        self._run(name, None)
+                        break
+                else:
+                    if any(n.startswith(text) for n in arg + plain):
+                        return      # incomplete
+                    # gibberish: skip a character
+                    del self._rx[:1]
+
+    def _config(self):
+        if self.version:
+            return {'start': self.start, 'interval_ms': self.interval_ms, 'name': self.name,
+                    'use_tsys01': 1, 'use_tmp117': 0, 'use_light': int(self.use_light), 'rt_output': 0}
+        code = {200: '0', 1000: '1', 60000: '2'}[self.interval_ms]
+        return '{},{},{}'.format(self.start, self.stop or 0, code)
+
+    def _run(self, name, a):
+        self._catch_up()
+        if name in ['read_range', 'spi_flash_read_range']:
+            begin, end = [int(x, 16) for x in a.split(',')]
+            d = bytes(self.flash[begin:end + 1])
+            self._send(d + self._crc(d))
+        elif name == 'id':
+            self._line(json.dumps({'ver': self.version, 'id': self.id}))
+        elif name == 'get_config':
+            self._line(json.dumps(self._config()))
+        elif name == 'get_logging_config':
+            self._line(self._config())
+        elif name == 'get_logger_name':
+            self._line(self.name)
+        elif name == 'spi_flash_get_unique_id':
+            self._line(self.id)
+        elif name == 'status':
+            self._line(json.dumps({'is_logging': int(self.logging), 'Vb': self.vbatt}))
+        elif name == 'is_logging':
+            self._line('{},0,0'.format(int(self.logging)))
+        elif name == 'read_sys_volt':
+            self._line('0,{}'.format(self.vbatt))
+        elif name in ['T', 'read_temperature']:
+            self._line('25.000' + ('' if self.version else 'Deg.C'))
+        elif name in ['P', 'read_pressure']:
+            self._line('101.325' + ('' if self.version else 'kPa'))
+        elif name == 'L':
+            self._line('1.0,2.0,3,4,5,6')
+        elif name in ['read_ambient_lx', 'read_white_lx']:
+            self._line('1.0lx,0')
+        elif name == 'read_rgbw':
+            self._line('3,4,5,6')
+        elif name == 'read_rtc':
+            self._line('{:.0f}'.format(time.time()))
+        elif name == 'write_rtc':
+            self._line(a)
+        elif name == 'start_logging':
+            self.logging = True
+            self.start = int(a) if a else int(time.time())
+            self.stop = None
+            if self.version:
+                self._line('OK')
+        elif name == 'stop_logging':
+            self.logging = False
+            self.stop = int(time.time())
+            if self.version:
+                self._line('OK')
+        elif name == 'set_logging_interval':
+            if self.version:
+                self.interval_ms = int(a)
+                self._line('OK')
+            else:
+                self.interval_ms = {0: 200, 1: 1000, 2: 60000}[int(a)]
+        elif name == 'set_logger_name':
+            self.name = a[:15]
+        elif name in ['enable_light_sensors', 'disable_light_sensors']:
+            self.use_light = name.startswith('enable')
+            self._line('OK')
+        elif name == 'clear_memory':
+            self.flash[:] = b'\xff'*SPI_FLASH_SIZE_BYTE
+            self._sample_count = 0
+            self._send(b'....done.\r\n')
+        elif name == 'rt0':
+            self._line('OK')
+
+
+def serve_pty(sim):
+    """Serve a SimulatedLogger on a pseudo-terminal. Returns the device path
+    for serial.Serial() to open. The serving threads are daemons."""
+    from dev.capture import open_pty, serve_pty
+    master, path = open_pty()
+    sim.timeout = 0.01
+    serve_pty(master, sim)
+    return path
+
+
+if '__main__' == __name__:
+
+    import sys
+    logging.basicConfig(level=logging.INFO)
+
+    # python -m dev.simulator [VERSION [SAMPLE_COUNT [BAUDRATE]]]
+    version = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    sample_count = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    baudrate = int(sys.argv[3]) if len(sys.argv) > 3 else 115200
+    sim = SimulatedLogger(version=version, sample_count=sample_count, baudrate=baudrate, latency=0.02)
+    print('Simulated v{} logger with {:,} samples on {}. Ctrl+C to stop.'.format(version, sample_count, serve_pty(sim)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
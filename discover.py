@@ -1,56 +1,218 @@
-# Search for loggers. Display their metadata if found. Only show newly found ones.
+# Search for loggers on every serial port at once, and keep watching: ports
+# that appear (a logger docked, a hub plugged in) are probed as soon as they
+# show up, ports that go away are dropped. Shows a table of what's on each
+# port whenever it changes.
+#
+# All candidate ports are probed concurrently with short timeouts, so a hub
+# full of loggers takes about as long as one logger.
+#
+# A port is only opened when it shows up, and then with an exclusive lock:
+# pyserial doesn't lock ports on POSIX by itself, and probing a port that
+# another program is downloading from would ruin the download. Ports that are
+# busy are left out of the table and tried again later.
 #
 # Stanley H.I. Lio
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
-import time, logging, random
+import time, logging
+from concurrent.futures import ThreadPoolExecutor
 from serial import Serial
+from serial.serialutil import SerialException
 from kiwi import Kiwi
-from common import ts2dt
+from common import serial_port_best_guess2
+
+
+# Serial timeout while probing. Loggers seen before answer in one round trip
+# (see identity.tmp); only a v0 logger never seen before needs the whole of
+# it, once.
+PROBE_TIMEOUT = 0.5
+# Look for ports coming and going this often
+POLL_INTERVAL = 1
+# Busy ports are tried again this often, and ports with a logger on them are
+# rechecked this often if there is a way to do that without opening them
+# again (see Discovery)
+REPROBE_INTERVAL = 10
+# Probe at most this many ports at a time
+MAX_WORKERS = 16
+
+
+def probe(port, *_, timeout=PROBE_TIMEOUT):
+    """What's on port: {'port', 'id', 'name', 'version', 'vbatt',
+    'logging'}, or None if no logger answered. Raises SerialException if
+    the port can't be opened (e.g. something else has it)."""
+    with Serial(port, 115200, timeout=timeout, exclusive=True) as ser:
+        try:
+            kiwi = Kiwi(ser)
+            config = kiwi.get_config(use_cached=True)
+            is_logging, vbatt = kiwi.batch(['is_logging', 'get_battery_voltage'])
+            return {'port':port,
+                    'id':config['id'],
+                    'name':config['name'],
+                    'version':kiwi._version,
+                    'vbatt':vbatt,
+                    'logging':is_logging}
+        except (SerialException, OSError, RuntimeError, UnicodeDecodeError, ValueError, IndexError, TypeError, KeyError) as e:
+            logging.debug('{}: {}'.format(port, e))
+    return None
+
+
+class Discovery:
+    """Live table of the loggers on this machine's serial ports.
+
+    Call poll() every now and then. table maps each port to what probe()
+    found there (None: nothing answered); ports still being probed, and
+    ports that are busy, aren't in it. Pass another probe function to keep
+    something else per port (it's called as probe(port, timeout=...), and
+    raises SerialException if the port is busy).
 
-logging.basicConfig(level=logging.DEBUG)
+    A port is probed when it shows up, and again only if it goes away and
+    comes back (or after forget()); a busy one is tried again every
+    REPROBE_INTERVAL. If given, recheck(port, row, timeout=...) is called
+    every REPROBE_INTERVAL for a port that has something on it, to refresh
+    its row over a connection that is kept open rather than by opening the
+    port again; it returns the port's new row, which is row itself if
+    nothing changed."""
 
-# find the serial port to use from user, from history, or make a guess
-# if on Windows, print the list of COM ports
-from common import serial_port_best_guess, save_default_port
-print('Detected ports:')
-DEFAULT_PORT = serial_port_best_guess(prompt=True)
-print('- - -')
-PORT = input('PORT=? (default={})'.format(DEFAULT_PORT)).strip()
-# empty input, use default
-if '' == PORT:
-    PORT = DEFAULT_PORT
+    def __init__(self, *_, list_ports=serial_port_best_guess2, max_workers=MAX_WORKERS, timeout=PROBE_TIMEOUT, probe=probe, recheck=None):
+        self.table = {}
+        self._list_ports = list_ports
+        self._probe = probe
+        self._recheck = recheck
+        self._timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._probing = {}      # port: Future
+        self._probed_at = {}
+        self._busy = set()
 
+    def poll(self):
+        """Pick up finished probes, drop ports that are gone, and start
+        probing the new ones (and the busy ones, and rechecking the occupied
+        ones, every REPROBE_INTERVAL). Returns the set of ports whose entry
+        in table changed."""
+        changed = set()
 
-with Serial(PORT, 115200, timeout=1) as ser:
+        for port, f in list(self._probing.items()):
+            if f.done():
+                del self._probing[port]
+                try:
+                    row = f.result()
+                except SerialException as e:
+                    logging.debug('{} is busy: {}'.format(port, e))
+                    self._busy.add(port)
+                    if port in self.table:
+                        del self.table[port]
+                        changed.add(port)
+                    continue
+                self._busy.discard(port)
+                if port not in self.table or self.table[port] != row:
+                    changed.add(port)
+                self.table[port] = row
 
-    save_default_port(PORT)
+        ports = set(self._list_ports())
+        for port in (set(self.table) | set(self._probing) | self._busy) - ports:
+            logging.debug('{} is gone'.format(port))
+            self._busy.discard(port)
+            if port in self._probing:
+                self._probing.pop(port).cancel()
+            if port in self.table:
+                del self.table[port]
+                changed.add(port)
 
-    known_ids = set()
+        now = time.time()
+        for port in ports - set(self._probing):
+            if port in self.table:
+                # never open a port again just to look: it might be in use
+                # by something that doesn't lock it
+                row = self.table[port]
+                if row is None or self._recheck is None or now - self._probed_at[port] < REPROBE_INTERVAL:
+                    continue
+                self._probed_at[port] = now
+                self._probing[port] = self._executor.submit(self._recheck, port, row, timeout=self._timeout)
+                continue
+            if port in self._busy and now - self._probed_at[port] < REPROBE_INTERVAL:
+                continue
+            self._probed_at[port] = now
+            self._probing[port] = self._executor.submit(self._probe, port, timeout=self._timeout)
 
-    while True:
+        return changed
+
+    def forget(self, port):
+        """Probe port again at the next poll()."""
+        self.table.pop(port, None)
+
+    def busy(self):
+        """True while any probe is in progress."""
+        return len(self._probing) > 0
+
+    def close(self):
+        for f in self._probing.values():
+            f.cancel()
+        self._executor.shutdown(wait=True)
+
+
+def discover(ports=None, *_, max_workers=MAX_WORKERS, timeout=PROBE_TIMEOUT):
+    """Probe every port (default: every candidate port) at once. Returns
+    {port: probe()} for the ports where a logger answered."""
+    if ports is None:
+        ports = serial_port_best_guess2()
+    if not len(ports):
+        return {}
+    def f(port):
         try:
-            kiwi = Kiwi(ser)
-            config = kiwi.get_config(use_cached=True)
+            return probe(port, timeout=timeout)
+        except SerialException as e:
+            logging.debug('{}: {}'.format(port, e))
+        return None
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        R = executor.map(f, ports)
+        return {port:row for port, row in zip(ports, R) if row is not None}
+
+def print_table(table):
+    print('{:<16} {:<16} {:<15} {:>3} {:>6}  {}'.format('PORT', 'ID', 'NAME', 'VER', 'VBATT', 'STATE'))
+    for port in sorted(table):
+        row = table[port]
+        if row is None:
+            print('{:<16} {}'.format(port[-16:], '(no logger)'))
+            continue
+        print('{:<16} {:<16} {:<15} {:>3} {:>6}  {}'.format(
+            port[-16:],
+            row['id'],
+            row['name'][:15],
+            row['version'],
+            '{:.2f}'.format(row['vbatt']) if row['vbatt'] is not None else '',
+            'LOGGING' if row['logging'] else 'not logging'))
+    print()
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.WARNING)
 
-            if config['id'] not in known_ids:
-                known_ids.add(config['id'])
-                print('Found "{}" (ID={}); battery={:.1f} V; {}.'.format(config['name'],
-                                                                         config['id'],
-                                                                         kiwi.get_battery_voltage(),
-                                                                         'LOGGING' if kiwi.is_logging() else 'not logging',
-                                                                         ))
-            else:
-                logging.debug('I have seen {} already.'.format(config['id']))
-
-            time.sleep(1)
-        except (UnicodeDecodeError, ValueError, IndexError, TypeError) as e:
-            logging.debug(e)
-        except RuntimeError:
-            if random.random() > 0.8:
-                print('[cricket sound]')
-            time.sleep(1)
-        except KeyboardInterrupt:
-            break
-
-        
+    print('Looking for loggers. Ctrl+C to stop.')
+    discovery = Discovery()
+    # which logger was last announced on each port
+    seen = {}
+    try:
+        while True:
+            changed = discovery.poll()
+            for port in sorted(changed):
+                row = discovery.table.get(port)
+                logger_id = row['id'] if row is not None else None
+                if seen.get(port) == logger_id:
+                    # same logger, only its state changed
+                    continue
+                seen[port] = logger_id
+                if row is not None:
+                    print('Found "{}" (ID={}) on {}; battery={:.1f} V; {}.'.format(row['name'],
+                                                                                  row['id'],
+                                                                                  port,
+                                                                                  row['vbatt'],
+                                                                                  'LOGGING' if row['logging'] else 'not logging',
+                                                                                  ))
+            if len(changed):
+                print_table(discovery.table)
+            time.sleep(0.1 if discovery.busy() else POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        discovery.close()
@@ -0,0 +1,289 @@
+# Keep every attached logger connected, and serve them over HTTP on
+# localhost, so that scripts and automation (and several of them at once)
+# don't each have to open the port, handshake, and fight over it.
+#
+# Ports are watched the same way discover.py does. Every logger gets one
+# Serial, one Kiwi and one KiwiScheduler for as long as it's plugged in;
+# short requests go ahead of downloads. Adapters can stay plugged in while
+# loggers are swapped on them, so the logger on each port is asked for its id
+# every now and then, and right before anything that changes it.
+#
+#   GET  /loggers                         what's connected
+#   GET  /loggers/ID/config[?refresh=1]   get_config()
+#   GET  /loggers/ID/status               is_logging, battery voltage
+#   GET  /loggers/ID/sensors              temperature, pressure, light
+#   GET  /loggers/ID/sample_count
+#   POST /loggers/ID/start                start_logging()
+#   POST /loggers/ID/stop                 stop_logging()
+#   GET  /loggers/ID/read_range?begin=0&end=0xffff
+#                                         raw flash, streamed as it's read
+#
+# Responses are JSON, {"result": ...} or {"error": "..."}, except read_range.
+# start and stop answer 409 if another logger has taken ID's place.
+#
+#   python gateway.py [HTTP_PORT]
+#   curl localhost:8372/loggers
+#
+# MESHLAB, UH Manoa
+import json, logging, sys, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from serial import Serial
+from serial.serialutil import SerialException
+from kiwi import Kiwi
+from scheduler import KiwiScheduler, INTERACTIVE, NORMAL, BULK, BULK_CHUNK_SIZE
+from discover import Discovery, POLL_INTERVAL
+
+
+# Only reachable from this machine
+HOST = '127.0.0.1'
+HTTP_PORT = 8372
+# Serial timeout for connections the gateway keeps
+SERIAL_TIMEOUT = 1
+
+
+class Connection:
+    """One logger, kept open. Takes over ser (closes it if there's no
+    logger on it)."""
+
+    def __init__(self, ser):
+        self.port = ser.port
+        self.ser = ser
+        try:
+            self.kiwi = Kiwi(self.ser)
+            self.id = self.kiwi.get_config(use_cached=True)['id']
+        except:
+            self.ser.close()
+            raise
+        self.scheduler = KiwiScheduler(self.kiwi)
+
+    def close(self):
+        self.scheduler.close()
+        self.ser.close()
+
+    def still_there(self):
+        """True if the logger on the port is still this one (asked for its id,
+        ahead of anything else queued)."""
+        try:
+            return self.id == self.scheduler.call('get_id', priority=INTERACTIVE)
+        except (SerialException, OSError, RuntimeError, UnicodeDecodeError, ValueError, IndexError, TypeError, KeyError) as e:
+            logging.debug('{}: {}'.format(self.port, e))
+        return False
+
+
+def connect(port, *_, timeout=None):
+    """A Connection to the logger on port, or None. Raises SerialException
+    if the port can't be opened (something else has it)."""
+    # locked, so discover.py and other gateways keep off it
+    ser = Serial(port, 115200, timeout=SERIAL_TIMEOUT, exclusive=True)
+    try:
+        return Connection(ser)
+    except (SerialException, OSError, RuntimeError, UnicodeDecodeError, ValueError, IndexError, TypeError, KeyError) as e:
+        logging.debug('{}: {}'.format(port, e))
+    return None
+
+def recheck(port, c, *_, timeout=None):
+    """c if its logger is still on port, or else a Connection to whatever is
+    there now (None if nothing)."""
+    if c.still_there():
+        return c
+    logging.info('{} is no longer on {}'.format(c.id, port))
+    c.close()
+    return connect(port)
+
+
+class Gateway:
+
+    def __init__(self, **kwargs):
+        """kwargs go to Discovery (list_ports...)."""
+        self._discovery = Discovery(probe=connect, recheck=recheck, **kwargs)
+        self._lock = threading.Lock()
+        self._connections = {}      # port: Connection
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def _watch(self):
+        while not self._stop.is_set():
+            self.poll()
+            self._stop.wait(0.1 if self._discovery.busy() else POLL_INTERVAL)
+
+    def poll(self):
+        # under the lock, so that drop() can't forget a port halfway through
+        with self._lock:
+            changed = self._discovery.poll()
+            for port in changed:
+                old = self._connections.pop(port, None)
+                if old is not None:
+                    logging.info('{} ({}) gone'.format(old.id, port))
+                    old.close()
+                new = self._discovery.table.get(port)
+                if new is not None:
+                    logging.info('{} ({}) connected'.format(new.id, port))
+                    self._connections[port] = new
+
+    def find(self, logger_id):
+        with self._lock:
+            for c in self._connections.values():
+                if c.id == logger_id:
+                    return c
+        return None
+
+    def loggers(self):
+        with self._lock:
+            C = list(self._connections.values())
+        return [{'id':c.id,
+                 'port':c.port,
+                 'name':c.kiwi.get_config(use_cached=True)['name'],
+                 'version':c.kiwi._version} for c in C]
+
+    def drop(self, c):
+        """c stopped working (unplugged...). Close it and look at its port
+        again."""
+        with self._lock:
+            if self._connections.get(c.port) is c:
+                del self._connections[c.port]
+                self._discovery.forget(c.port)
+        c.close()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._discovery.close()
+        with self._lock:
+            for c in self._connections.values():
+                c.close()
+            self._connections.clear()
+
+
+def make_handler(gateway):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, fmt, *args):
+            logging.debug(fmt % args)
+
+        def _reply(self, code, d):
+            body = json.dumps(d).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _route(self, method):
+            url = urlparse(self.path)
+            query = {k:v[-1] for k, v in parse_qs(url.query).items()}
+            P = [p for p in url.path.split('/') if len(p)]
+
+            if ['loggers'] == P and 'GET' == method:
+                return self._reply(200, {'result':gateway.loggers()})
+            if 3 != len(P) or 'loggers' != P[0]:
+                return self._reply(404, {'error':'No such thing'})
+
+            c = gateway.find(P[1])
+            if c is None:
+                return self._reply(404, {'error':'Logger {} is not connected'.format(P[1])})
+            op = (method, P[2])
+            s = c.scheduler
+            try:
+                if ('GET', 'read_range') == op:
+                    return self._read_range(c, int(query['begin'], 0), int(query['end'], 0))
+                if ('GET', 'config') == op:
+                    r = s.call('get_config', use_cached=query.get('refresh') not in ['1', 'true'], priority=INTERACTIVE)
+                elif ('GET', 'status') == op:
+                    is_logging, vbatt = s.call('batch', ['is_logging', 'get_battery_voltage'], priority=INTERACTIVE)
+                    r = {'is_logging':is_logging, 'vbatt':vbatt}
+                elif ('GET', 'sensors') == op:
+                    names = ['read_temperature', 'read_pressure']
+                    if c.kiwi.get_config(use_cached=True)['use_light']:
+                        names.append('read_light')
+                    R = s.call('batch', names, priority=INTERACTIVE)
+                    r = {'temperature':R[0], 'pressure':R[1]}
+                    if len(R) > 2:
+                        r['light'] = dict(zip(('hdr_als', 'hdr_w', 'r', 'g', 'b', 'w'), R[2]))
+                elif ('GET', 'sample_count') == op:
+                    r = s.call('get_sample_count', priority=NORMAL)
+                elif ('POST', 'start') == op or ('POST', 'stop') == op:
+                    # the port may have another logger on it by now; don't
+                    # start or stop that one instead
+                    if not c.still_there():
+                        gateway.drop(c)
+                        return self._reply(409, {'error':'Logger {} is no longer on {}'.format(c.id, c.port)})
+                    r = s.call('start_logging' if 'start' == P[2] else 'stop_logging', priority=NORMAL)
+                else:
+                    return self._reply(404, {'error':'No such operation'})
+            except (KeyError, ValueError) as e:
+                return self._reply(400, {'error':'Bad request ({})'.format(e)})
+            except (SerialException, OSError) as e:
+                gateway.drop(c)
+                return self._reply(503, {'error':'Lost the logger ({})'.format(e)})
+            except Exception as e:
+                logging.exception(e)
+                return self._reply(500, {'error':str(e) or type(e).__name__})
+            return self._reply(200, {'result':r})
+
+        def _read_range(self, c, begin, end):
+            if not 0 <= begin <= end < Kiwi.SPI_FLASH_SIZE_BYTE:
+                return self._reply(400, {'error':'Bad range'})
+            # queue all the chunks now so they are read back to back, but
+            # each one on its own so that other requests can cut in
+            F = [c.scheduler.submit(BULK, 'read_range_repair', a, min(a + BULK_CHUNK_SIZE - 1, end))
+                 for a in range(begin, end + 1, BULK_CHUNK_SIZE)]
+            try:
+                line = F[0].result()
+                if line is None:
+                    return self._reply(502, {'error':'Could not read the logger'})
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(end - begin + 1))
+                self.end_headers()
+                self.wfile.write(line)
+                for f in F[1:]:
+                    line = f.result()
+                    if line is None:
+                        # too late for an error status; cut it short
+                        logging.error('read_range {:X}-{:X} on {} failed'.format(begin, end, c.id))
+                        self.close_connection = True
+                        return
+                    self.wfile.write(line)
+            except (SerialException, OSError) as e:
+                # either end went away
+                logging.debug(e)
+                self.close_connection = True
+                if isinstance(e, SerialException):
+                    gateway.drop(c)
+            finally:
+                for f in F:
+                    f.cancel()
+
+        def do_GET(self):
+            self._route('GET')
+
+        def do_POST(self):
+            self._route('POST')
+
+    return Handler
+
+
+def serve(*_, host=HOST, port=HTTP_PORT, **kwargs):
+    """Run the gateway until interrupted."""
+    gateway = Gateway(**kwargs)
+    server = ThreadingHTTPServer((host, port), make_handler(gateway))
+    server.daemon_threads = True
+    logging.info('Listening on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        gateway.close()
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('kiwi').setLevel(logging.WARNING)
+
+    serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else HTTP_PORT)
@@ -1,162 +1,834 @@
 import json, logging, sys, string, struct, time, math, re
+from collections import deque, OrderedDict
+from datetime import datetime
+from os import makedirs, remove
+from os.path import join, exists, dirname
 from dev.crc_check import check_response
+from common import dt2ts, load_identity, save_identity, load_link_profile
 
 
 logger = logging.getLogger(__name__)
 
 
+def is_erased(buf):
+    """True if buf (bytes, bytearray or memoryview) is all 0xff, the way
+    erased NOR flash reads. Compares in C rather than byte by byte."""
+    return buf == b'\xff'*len(buf)
+
+
+# Parsers for the responses to each query, shared with AsyncKiwi so that the
+# two read the firmware the same way.
+
+def parse_config_v0(r_config, r_name, r_id):
+    """The config from the responses to get_logging_config, get_logger_name
+    and spi_flash_get_unique_id, or None if there was none."""
+    if not len(r_config):
+        return None
+    r = r_config.decode().strip().split(',')
+    config = {
+        'start':int(r[0]),
+        'stop':int(r[1]),
+        'interval_ms':{'0':200, '1':1000, '2':60000}.get(r[2])}
+
+    r = r_name.strip()
+    config['name'] = r.decode() if not is_erased(r) else ''
+    config['use_tsys01'] = 1
+    config['use_tmp117'] = 0
+    config['use_light'] = 1
+    config['rt_output'] = 0
+
+    config['id'] = parse_id_v0(r_id)
+    if 16 != len(config['id']) or not config['id'].startswith('E') or not all([c in string.hexdigits for c in config['id']]):
+        logger.warning('Serial number ain\'t right...')
+    return config
+
+def parse_config_v1(r_config, r_id):
+    """The config from the responses to get_config and id."""
+    try:
+        r = re.sub(rb'\bnan\b', b'NaN', r_config)
+        config = json.loads(r.decode().strip())
+        if 'stop' not in config:
+            config['stop'] = None
+        config['id'] = parse_id_v1(r_id)
+    except json.decoder.JSONDecodeError:
+        logger.debug(r_config)
+        if 0 == len(r_config):
+            logger.warning('(no response)')
+        raise RuntimeError('Could not get config from logger.')
+    return config
+
+def parse_id_v0(r):
+    return r.decode().strip()
+
+def parse_id_v1(r):
+    return json.loads(r.decode().strip())['id']
+
+def parse_is_logging_v0(r):
+    r = r.decode().strip().split(',')
+    if len(r) == 3 and r[0] in ['0', '1']:
+        return '1' == r[0]
+
+def parse_is_logging_v1(r):
+    return 1 == json.loads(r.decode().strip())['is_logging']
+
+def parse_battery_v0(r):
+    return round(float(r.decode().strip().split(',')[1]), 2)
+
+def parse_battery_v1(r):
+    return float(json.loads(r.decode().strip())['Vb'])
+
+def parse_float(r, unit):
+    try:
+        return float(r.strip().decode().replace(unit, ''))
+    except:
+        logger.exception('')
+        return float('nan')
+
+def parse_light_v0(r_als, r_white, r_rgbw):
+    d = []
+    d.append(float(r_als.decode().strip().split(',')[0].replace('lx', '')))
+    d.append(float(r_white.decode().strip().split(',')[0].replace('lx', '')))
+    d.extend([int(float(x)) for x in r_rgbw.decode().strip().split(',')])
+    return d
+
+def parse_light_v1(r):
+    r = [float(x) for x in r.decode().strip().split(',')]
+
+    '''# raw to lux for VEML6030
+    def c(v):
+        v *= 1.8432
+        if v > 1e3:
+            v = 6.0135e-13*v*v*v*v - 9.3924e-9*v*v*v + 8.1488e-5*v*v + 1.0023*v;    # >1klx correction
+        return v
+    r[0] = c(r[0])
+    r[1] = c(r[1])
+
+    c = lambda x: 0.25168*x
+    r[2] = c(r[2])
+    r[3] = c(r[3])
+    r[4] = c(r[4])
+    r[5] = c(r[5])'''
+
+    return r
+
+def check_range_response(line, expected_length):
+    """What's wrong with a read_range response (data followed by its CRC32):
+    'short', 'crc', or None if nothing."""
+    if len(line) != expected_length:
+        return 'short'
+    if not check_response(line):
+        return 'crc'
+    return None
+
+
+class FlowControl:
+    """Keeps count of the command bytes sent to the logger that it may not
+    have acted on yet, so that no more than budget of them are ever waiting
+    in its RX buffer.
+
+    A command that gets a response is done once its response has been read
+    (done()). One that doesn't (LEDs...) is taken to be done SETTLE seconds
+    after everything sent before it is done."""
+
+    SETTLE = 0.02
+
+    def __init__(self, budget):
+        self.budget = budget
+        # [byte count, expects a response, done-by time (no-response only)]
+        self._queue = deque()
+
+    def _expire(self):
+        now = time.time()
+        while len(self._queue) and not self._queue[0][1]:
+            if self._queue[0][2] is None:
+                self._queue[0][2] = now + FlowControl.SETTLE
+            if now < self._queue[0][2]:
+                break
+            self._queue.popleft()
+
+    def outstanding(self):
+        self._expire()
+        return sum(n for n, _, _ in self._queue)
+
+    def fits(self, n):
+        """True if n more bytes can be sent now. Always true when nothing is
+        outstanding, so that a command longer than budget still goes out."""
+        outstanding = self.outstanding()
+        return 0 == outstanding or outstanding + n <= self.budget
+
+    def wait(self, n):
+        """Wait (for no-response commands to settle) until n more bytes fit.
+        Returns False without waiting if it's a response that is holding
+        things up; read that first."""
+        while not self.fits(n):
+            if any(r for _, r, _ in self._queue):
+                return False
+            time.sleep(FlowControl.SETTLE/4)
+        return True
+
+    def sent(self, n, *_, response=True):
+        self._queue.append([n, response, None])
+
+    def done(self):
+        """The response to the oldest command still waiting for one has been
+        read; that command and everything sent before it are done."""
+        while len(self._queue):
+            _, response, _ = self._queue.popleft()
+            if response:
+                break
+
+    def reset(self):
+        """Responses are being thrown away. Only commands that don't answer
+        are still worth waiting on."""
+        self._queue = deque(e for e in self._queue if not e[1])
+
+
+class PageCache:
+    """Flash pages already read, by page index. Least recently used ones go
+    first once they take up more than budget bytes."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def get(self, first, last):
+        """Pages first..last joined, or None unless they are all here."""
+        n = last - first + 1
+        if not all(p in self._pages for p in range(first, last + 1)):
+            self.misses += n
+            return None
+        self.hits += n
+        for p in range(first, last + 1):
+            self._pages.move_to_end(p)
+        return b''.join(self._pages[p] for p in range(first, last + 1))
+
+    def put(self, page, data):
+        self._pages[page] = bytes(data)
+        self._pages.move_to_end(page)
+        while len(self._pages)*len(data) > self.budget:
+            self._pages.popitem(last=False)
+
+    def clear(self):
+        self._pages.clear()
+
+    def __contains__(self, page):
+        return page in self._pages
+
+
+class PageStore:
+    """Flash pages of one logging session kept on disk, so that what any
+    script has read (the overview, the sample count, an interrupted
+    download) doesn't have to be read again, ever.
+
+    An append-only file of (page index, page) records. All of it is loaded
+    when opened (16 MB at most); a record cut short by a crash is ignored.
+    Pages go in only once verified, and only complete ones (see
+    Kiwi._cache_put()), so nothing in it can go stale as long as the session
+    lasts. Clearing the memory doesn't change the session's start time, so
+    Kiwi.clear_memory() deletes the file."""
+
+    _INDEX = struct.Struct('<I')
+
+    def __init__(self, fn, page_size):
+        self.fn = fn
+        self.page_size = page_size
+        self.hits = 0
+        self.misses = 0
+        self._pages = {}
+        record = PageStore._INDEX.size + page_size
+        if exists(fn):
+            with open(fn, 'rb') as f:
+                buf = f.read()
+            for i in range(0, len(buf) - record + 1, record):
+                page, = PageStore._INDEX.unpack_from(buf, i)
+                self._pages[page] = buf[i + PageStore._INDEX.size:i + record]
+            # drop a partial record so that new ones line up
+            if len(buf) % record:
+                with open(fn, 'r+b') as f:
+                    f.truncate(len(buf) - len(buf) % record)
+        self._file = open(fn, 'ab')
+
+    def get(self, first, last):
+        """Pages first..last joined, or None unless they are all here."""
+        n = last - first + 1
+        if not all(p in self._pages for p in range(first, last + 1)):
+            self.misses += n
+            return None
+        self.hits += n
+        return b''.join(self._pages[p] for p in range(first, last + 1))
+
+    def put(self, page, data):
+        if page in self._pages:
+            return
+        self._pages[page] = bytes(data)
+        self._file.write(PageStore._INDEX.pack(page) + self._pages[page])
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __contains__(self, page):
+        return page in self._pages
+
+    def __len__(self):
+        return len(self._pages)
+
+
+class LinkTimer:
+    """Learns how long the logger takes to answer each command on a link,
+    and how fast bulk data comes over it, and sets the timeout of each read
+    from those: the command's usual latency plus a margin for its variance
+    (smoothed the way TCP does its RTT), plus the time the expected
+    response takes to arrive at the measured byte rate.
+
+    A command it knows nothing about yet gets the caller's default."""
+
+    # USB serial adapters can sit on data for up to 16 ms, and the logger may
+    # be busy taking a sample; never give up sooner than this
+    MIN_LATENCY = 0.1
+    # allow responses to come this much slower than the measured byte rate
+    TRANSFER_MARGIN = 1.5
+    # responses at least this long are used to measure the byte rate
+    MIN_RATE_SAMPLE_BYTE = 4096
+    # a response that misses its timeout gets up to this many times the
+    # timeout in all before it counts as lost (like TCP backing off its RTO)
+    BACKOFF = 4
+
+    def __init__(self, byte_rate):
+        self.byte_rate = byte_rate
+        # command: [smoothed latency, mean deviation], in second
+        self._latency = {}
+
+    def timeout(self, cmd, nbytes=0, *_, default=None, probe=False):
+        """Seconds to wait for the response to cmd, nbytes long (0 for a
+        line). With probe=True, a command not seen before gets the slowest
+        latency seen on the link rather than the default: fine for "are you
+        there?" commands, not for ones that make the logger do real work."""
+        if cmd in self._latency:
+            latency, deviation = self._latency[cmd]
+        elif probe and len(self._latency):
+            latency, deviation = max(self._latency.values(), key=lambda v: v[0] + 4*v[1])
+        else:
+            return default
+        return max(LinkTimer.MIN_LATENCY, latency + 4*deviation) + LinkTimer.TRANSFER_MARGIN*nbytes/self.byte_rate
+
+    def sample(self, cmd, elapsed, nbytes=0):
+        """The response to cmd (nbytes of it, or 0 for a line) was complete
+        elapsed seconds after cmd was sent."""
+        if nbytes >= LinkTimer.MIN_RATE_SAMPLE_BYTE and cmd in self._latency:
+            rate = nbytes/max(1e-3, elapsed - self._latency[cmd][0])
+            self.byte_rate += (rate - self.byte_rate)/4
+        latency = max(0, elapsed - nbytes/self.byte_rate)
+        if cmd not in self._latency:
+            self._latency[cmd] = [latency, latency/2]
+        else:
+            v = self._latency[cmd]
+            v[1] += (abs(v[0] - latency) - v[1])/4
+            v[0] += (latency - v[0])/8
+
+    def timed_out(self, cmd):
+        """Forget what was learned about cmd: back to the default."""
+        self._latency.pop(cmd, None)
+
+
+class CommandStats:
+    """Per command (by name, arguments left out): how many were sent, bytes
+    each way, time spent waiting for the responses (with a histogram),
+    timeouts and CRC failures. For finding out where the time goes in a
+    slow download: handshakes, timeouts, retries, or the link itself.
+
+    One can be shared by several Kiwi objects, e.g. across reconnects."""
+
+    # upper bounds of the histogram buckets, in second
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+
+    def __init__(self):
+        self.commands = {}
+
+    def _get(self, cmd):
+        cmd = cmd.decode()
+        c = self.commands.get(cmd)
+        if c is None:
+            c = self.commands[cmd] = {'count':0,
+                                      'byte_out':0,
+                                      'byte_in':0,
+                                      'wait':0.,
+                                      'histogram':[0]*len(CommandStats.BUCKETS),
+                                      'timeout':0,
+                                      'late':0,
+                                      'crc_error':0}
+        return c
+
+    def sent(self, cmd, n):
+        c = self._get(cmd)
+        c['count'] += 1
+        c['byte_out'] += n
+
+    def received(self, cmd, n, wait):
+        """n bytes of response to cmd came in after waiting wait seconds."""
+        c = self._get(cmd)
+        c['byte_in'] += n
+        c['wait'] += wait
+        for i, bound in enumerate(CommandStats.BUCKETS):
+            if wait <= bound:
+                c['histogram'][i] += 1
+                break
+
+    def late(self, cmd, n, wait):
+        """The rest of a response (n bytes) that missed its timeout came in
+        after waiting another wait seconds."""
+        c = self._get(cmd)
+        c['late'] += 1
+        c['byte_in'] += n
+        c['wait'] += wait
+
+    def timed_out(self, cmd):
+        self._get(cmd)['timeout'] += 1
+
+    def crc_error(self, cmd):
+        self._get(cmd)['crc_error'] += 1
+
+    def to_json(self):
+        # the last histogram bucket is everything above the last bound
+        return json.dumps({'buckets':CommandStats.BUCKETS[:-1], 'commands':self.commands}, indent=2)
+
+    def to_prometheus(self, *_, prefix='kiwi_'):
+        """The Prometheus text exposition format."""
+        L = []
+        def metric(name, kind, doc, samples):
+            L.append('# HELP {}{} {}'.format(prefix, name, doc))
+            L.append('# TYPE {}{} {}'.format(prefix, name, kind))
+            L.extend('{}{}{{{}}} {}'.format(prefix, name, labels, v) for labels, v in samples)
+
+        C = sorted(self.commands.items())
+        for k, name, doc in [('count', 'commands_total', 'Commands sent'),
+                             ('byte_out', 'sent_bytes_total', 'Command bytes sent'),
+                             ('byte_in', 'received_bytes_total', 'Response bytes received'),
+                             ('timeout', 'timeouts_total', 'Responses that were short or missing'),
+                             ('late', 'late_total', 'Responses completed after their timeout'),
+                             ('crc_error', 'crc_errors_total', 'Responses that failed their CRC')]:
+            metric(name, 'counter', doc, [('command="{}"'.format(cmd), c[k]) for cmd, c in C])
+
+        metric('response_wait_seconds', 'histogram', 'Time spent waiting for responses', [])
+        for cmd, c in C:
+            n = 0
+            for bound, count in zip(CommandStats.BUCKETS, c['histogram']):
+                n += count
+                le = '+Inf' if float('inf') == bound else bound
+                L.append('{}response_wait_seconds_bucket{{command="{}",le="{}"}} {}'.format(prefix, cmd, le, n))
+            L.append('{}response_wait_seconds_sum{{command="{}"}} {}'.format(prefix, cmd, c['wait']))
+            L.append('{}response_wait_seconds_count{{command="{}"}} {}'.format(prefix, cmd, n))
+        return '\n'.join(L) + '\n'
+
+    def save(self, fn):
+        """To fn, as Prometheus text if it ends in .prom, otherwise as
+        JSON."""
+        with open(fn, 'w') as f:
+            f.write(self.to_prometheus() if fn.endswith('.prom') else self.to_json())
+
+
 class Kiwi:
     SPI_FLASH_SIZE_BYTE = 16*1024*1024
     SPI_FLASH_PAGE_SIZE_BYTE = 256
     SPI_FLASH_PAGE_COUNT = SPI_FLASH_SIZE_BYTE/SPI_FLASH_PAGE_SIZE_BYTE
+    # The firmware starts dropping input somewhere around 763 bytes of unread
+    # commands. Stay well clear of that when queueing up requests. Measured
+    # by dev/comm_link_stress_test.py, per firmware version; what it saves in
+    # link_profile.json takes precedence.
+    RX_BUFFER_BUDGET_BYTE = {0:512, 1:512}
+    # pages either side of the predicted last page that
+    # find_last_used_page() reads first
+    SEARCH_BRACKET = 1
+    # if the guess is off, try this many doubling steps away from it before
+    # bisecting what's left
+    SEARCH_GALLOP = 4
+    # default size of the page cache, see enable_page_cache()
+    PAGE_CACHE_BYTE = 1024*1024
+    # page stores go in here, next to the downloads, see enable_page_store()
+    PAGE_STORE_DIR = 'data'
+
+    # What has been learned about each serial port, {port: {'version',
+    # 'timer'}}, so the next Kiwi on the same port starts from there.
+    _links = {}
    
-    def __init__(self, ser):
+    def __init__(self, ser, *_, lazy=False, stats=None):
+        """With lazy=True, nothing is sent until something needs the
+        version, the config or the sample layout. Either way, a logger seen
+        on this port before (the id, version and sample layout are kept in
+        identity.tmp next to saw.tmp) is only checked for being the same
+        one, in one round trip.
+
+        stats: a CommandStats to count every command in (see
+        enable_stats())."""
         self._ser = ser
+        port = getattr(ser, 'port', None)
+        self._port = port
+        self._identity = None
+        self._link = {'version':None,
+                      'timer':LinkTimer((getattr(ser, 'baudrate', None) or 115200)/10)}
+        if port is not None:
+            self._link = Kiwi._links.setdefault(port, self._link)
+        self._timer = self._link['timer']
+        # what time it is, as far as the logger is concerned (a replayed
+        # capture has its own, see dev/capture.py)
+        self._clock = getattr(ser, 'clock', time.time)
+        # when the command being waited on was sent, if nothing was ahead of
+        # it (only then does it say anything about latency)
+        self._sent_at = None
+        # unacknowledged command bytes. The most conservative budget until
+        # the version is known.
+        self._flow = FlowControl(min(Kiwi.RX_BUFFER_BUDGET_BYTE.values()))
+        # byte/s of the last read_range_pipelined(), and why the last range
+        # it failed to read failed
+        self.throughput = None
+        self.pipeline_error = None
+        # receive buffer for read_range_pipelined()
+        self._rxbuf = bytearray()
+        # number of command/response exchanges so far (pipelined reads count
+        # one per request even though they overlap)
+        self.round_trips = 0
+        # off unless enable_page_cache() / enable_page_store()
+        self.page_cache = None
+        self.page_store = None
+        self.stats = stats
+
+        self._lazy = lazy
+        if not lazy:
+            self._handshake()
+
+    # looking any of these up before the handshake does the handshake
+    _HANDSHAKE_ATTR = ('_version', '_config', 'sample_struct_fmt', 'SAMPLE_SIZE_BYTE', 'SAMPLE_PER_PAGE')
+
+    def __getattr__(self, name):
+        # only called for attributes that aren't there
+        if name in Kiwi._HANDSHAKE_ATTR:
+            self._handshake()
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def _handshake(self):
         self._version = None
         self._config = None
-        
-        self.identify_version()
+
+        self._identity = load_identity(self._port) if self._port is not None else None
+        known = self._identity
+        if known is not None:
+            self._version = known['version']
+            if self._revalidate(known['id']):
+                logger.debug('Same logger as last time on {}'.format(self._port))
+                self._flow.budget = self._rx_budget()
+                if self._lazy:
+                    self._set_layout(known['use_light'])
+                else:
+                    self.get_config()
+                return
+            self._version = None
+            self._config = None
+
+        if self.identify_version() is None:
+            raise RuntimeError('No logger found.')
         logger.debug('Version={}'.format(self._version))
+        self._flow.budget = self._rx_budget()
 
         self.get_config()
         logger.debug(self._config)
 
-        self.sample_struct_fmt = 'ffHHHHHH' if self._config['use_light'] else 'ff'
+    def link_profile(self):
+        """What dev/comm_link_stress_test.py measured for this firmware
+        version (see common.load_link_profile()), or {}."""
+        return load_link_profile(self._version) or {}
+
+    def _rx_budget(self):
+        return self.link_profile().get('rx_budget') or Kiwi.RX_BUFFER_BUDGET_BYTE.get(self._version, self._flow.budget)
+
+    def _revalidate(self, logger_id):
+        """True if the logger on the port has this id (and speaks
+        self._version). Asks just for the id, so that a wrong guess costs one
+        timeout."""
+        try:
+            if 0 == self._version:
+                cmd, parse = b'spi_flash_get_unique_id', parse_id_v0
+            else:
+                cmd, parse = b'id', parse_id_v1
+            self._flush()
+            self._write(cmd)
+            self.round_trips += 1
+            r = self._readline(cmd, probe=True)
+            self._flow.done()
+            logger.debug(r)
+            return logger_id == parse(r)
+        except (RuntimeError, UnicodeDecodeError, IndexError, KeyError, TypeError, ValueError) as e:
+            logger.debug(e)
+            self._drain()
+            return False
+
+    def _set_layout(self, use_light):
+        self.sample_struct_fmt = 'ffHHHHHH' if use_light else 'ff'
         self.SAMPLE_SIZE_BYTE = struct.calcsize(self.sample_struct_fmt)
         self.SAMPLE_PER_PAGE = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE//self.SAMPLE_SIZE_BYTE
 
-    def identify_version(self):
+    def _remember(self):
+        """Update the sample layout from the config, and what's on disk
+        about this port if anything changed."""
+        self._set_layout(self._config['use_light'])
+        if self._port is None:
+            return
+        identity = {'id':self._config['id'],
+                    'version':self._version,
+                    'use_light':self._config['use_light']}
+        if identity != self._identity:
+            try:
+                save_identity(self._port, identity)
+                self._identity = identity
+            except OSError as e:
+                logger.debug(e)
+
+    def _flush(self):
         self._ser.reset_input_buffer()
         self._ser.reset_output_buffer()
+        self._flow.reset()
 
-        try:
-            self._ser.write(b'id')
-            r = self._ser.readline()
-            logger.debug(r)
-            d = json.loads(r.decode().strip())
-            self._version = d['ver']
-            return self._version
-        except (UnicodeDecodeError, IndexError, TypeError, ValueError):
-            pass
+    def _write(self, cmd, *_, response=True):
+        """Write cmd once it fits in the firmware's RX buffer."""
+        if not self._flow.wait(len(cmd)):
+            logger.warning('RX budget exceeded with {} byte(s) outstanding'.format(self._flow.outstanding()))
+        self._sent_at = time.time() if 0 == self._flow.outstanding() else None
+        self._ser.write(cmd)
+        self._flow.sent(len(cmd), response=response)
+        if self.stats is not None:
+            self.stats.sent(Kiwi._key(cmd), len(cmd))
+
+    # commands that take arguments (hex ones can start with a letter)
+    _ARG_COMMANDS = (b'spi_flash_read_range', b'read_range', b'set_logging_interval',
+                     b'start_logging', b'write_rtc', b'set_logger_name')
+
+    @staticmethod
+    def _key(cmd):
+        """The command without its arguments, e.g. b'read_range'."""
+        for name in Kiwi._ARG_COMMANDS:
+            if cmd.startswith(name):
+                return name
+        return re.match(rb'[A-Za-z_]*', cmd).group()
+
+    def _readline(self, cmd, *_, probe=False):
+        """The response line to cmd, waiting as long as the link says it
+        should take."""
+        return self._timed(cmd, 0, lambda n: self._ser.readline(), probe=probe)
 
+    def _read(self, cmd, n, *_, default=None):
+        """The n-byte response to cmd, likewise."""
+        if default is None:
+            default = 1 + 2*n/self._timer.byte_rate
+        return self._timed(cmd, n, self._ser.read, default=default)
+
+    def _timed(self, cmd, n, read, *_, default=None, probe=False):
+        """read(k) reads (the rest of) the response: k more bytes, or the
+        rest of the line if n is 0. A response that takes longer than the
+        link says it should gets up to LinkTimer.BACKOFF times that (but no
+        more than default, or the port's own timeout) before it counts as
+        timed out. Probes get no second chance: they are meant to fail
+        fast."""
+        key = Kiwi._key(cmd)
+        old_timeout = self._ser.timeout
+        limit = old_timeout if default is None else default
+        learned = self._timer.timeout(key, n, probe=probe)
+        timeout = limit if learned is None else learned
+        incomplete = lambda r: len(r) < n or (0 == n and not r.endswith(b'\n'))
+        started = time.time()
+        rest = None
         try:
-            self._ser.write(b'is_logging')
-            r = self._ser.readline()
-            logger.debug(r)
-            if 3 == len(r.decode().strip().split(',')):
-                self._version = 0
-                return self._version
-        except (UnicodeDecodeError, IndexError, TypeError, ValueError):
-            pass
+            self._ser.timeout = timeout
+            r = read(n)
+            waited = time.time() - started
+            if incomplete(r) and learned is not None and not probe:
+                # slower than usual, not necessarily lost
+                deadline = LinkTimer.BACKOFF*learned
+                if limit is not None:
+                    deadline = min(deadline, limit)
+                if deadline > waited:
+                    self._ser.timeout = deadline - waited
+                    rest = read(n - len(r))
+                    r += rest
+        finally:
+            self._ser.timeout = old_timeout
+        if self.stats is not None:
+            self.stats.received(key, len(r) - len(rest or b''), waited)
+            if rest is not None:
+                self.stats.late(key, len(rest), time.time() - started - waited)
+        if incomplete(r):
+            self._timer.timed_out(key)
+            if self.stats is not None:
+                self.stats.timed_out(key)
+        elif self._sent_at is not None or rest is not None:
+            # a late one isn't a clean sample unless it was the only one in
+            # flight either, but it still says the estimate is too short
+            self._timer.sample(key, time.time() - (self._sent_at or started), n)
+        self._sent_at = None
+        return r
+
+    def send(self, cmd):
+        """Send a command that has no response (LEDs...), paced so that
+        sending many in a row doesn't overrun the logger."""
+        self._write(cmd, response=False)
+
+    def identify_version(self):
+        self._version = None
+        self._flush()
 
+        # whatever was on this port last time goes first, so it's usually
+        # the first probe that answers
+        probes = [self._probe_v1, self._probe_v0]
+        if 0 == self._link['version']:
+            probes.reverse()
+        for probe in probes:
+            try:
+                self._version = probe()
+            except (UnicodeDecodeError, IndexError, TypeError, ValueError):
+                continue
+            if self._version is not None:
+                self._link['version'] = self._version
+                break
         return self._version
 
-    def get_config(self, *_, use_cached=False):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+    def _probe_v1(self):
+        self._write(b'id')
+        self.round_trips += 1
+        r = self._readline(b'id', probe=True)
+        self._flow.done()
+        logger.debug(r)
+        d = json.loads(r.decode().strip())
+        return d['ver']
+
+    def _probe_v0(self):
+        self._write(b'is_logging')
+        self.round_trips += 1
+        r = self._readline(b'is_logging', probe=True)
+        self._flow.done()
+        logger.debug(r)
+        if 3 == len(r.decode().strip().split(',')):
+            return 0
 
+    def get_config(self, *_, use_cached=False):
         if use_cached and self._config is not None:
             return self._config
-        
-        if 0 == self._version:
-            self._ser.write(b'get_logging_config')
-            r = self._ser.readline()
-            logger.debug(r)
-            if not len(r):
-                return None
-            r = r.decode().strip().split(',')
-            config = {
-                'start':int(r[0]),
-                'stop':int(r[1]),
-                'interval_ms':{'0':200, '1':1000, '2':60000}.get(r[2])}
-
-            self._ser.write(b'get_logger_name')
-            r = self._ser.readline().strip()
-            logger.debug(r)
-            config['name'] = r.decode() if not all([0xff == b for b in r]) else ''
-            config['use_tsys01'] = 1
-            config['use_tmp117'] = 0
-            config['use_light'] = 1
-            config['rt_output'] = 0
-
-            self._ser.write(b'spi_flash_get_unique_id')
-            r = self._ser.readline()
-            logger.debug(r)
-            r = r.decode().strip()
-            if 16 != len(r) or not r.startswith('E') or not all([c in string.hexdigits for c in r]):
-                logger.warning('Serial number ain\'t right...')
-            config['id'] = r
+        config = self.batch(['get_config'])[0]
+        # use_light can be changed; keep the layout in step
+        if config is not None:
+            self._remember()
+        return config
 
-            self._config = config
-        else:
-            try:
-                self._ser.write(b'get_config')
-                self._ser.flushOutput()
-                r = self._ser.readline()
-                logger.debug(r)
-                r = re.sub(rb'\bnan\b', b'NaN', r)
-                config = json.loads(r.decode().strip())
-                if 'stop' not in config:
-                    config['stop'] = None
-
-                self._ser.write(b'id')
-                r = self._ser.readline()
-                logger.debug(r)
-                config['id'] = json.loads(r.decode().strip())['id']
-                self._config = config
-            except json.decoder.JSONDecodeError:
-                logger.debug(r)
-                if 0 == len(r):
-                    logger.warning('(no response)')
-                raise RuntimeError('Could not get config from logger.')
-
-        return self._config
+    def get_id(self):
+        """The logger's id, asked for on its own: one short round trip."""
+        return self.batch(['get_id'])[0]
 
     def is_logging(self):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
-
-        if 0 == self._version:
-            self._ser.write(b'is_logging')
-            r = self._ser.readline()
-            logger.debug(r)
-            r = r.decode().strip().split(',')
-            if len(r) == 3 and r[0] in ['0', '1']:
-                return '1' == r[0]
-        else:
-            self._ser.write(b'status')
-            r = self._ser.readline()
-            logger.debug(r)
-            return 1 == json.loads(r.decode().strip())['is_logging']
+        return self.batch(['is_logging'])[0]
 
     def get_battery_voltage(self):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+        return self.batch(['get_battery_voltage'])[0]
 
-        if 0 == self._version:
-            self._ser.write(b'read_sys_volt')
-            r = self._ser.readline()
-            logger.debug(r)
-            r = r.decode().strip().split(',')
-            return round(float(r[1]), 2)
-        else:
-            self._ser.write(b'status')
-            d = json.loads(self._ser.readline().decode().strip())
-            return float(d['Vb'])
+    def batch(self, names):
+        """Run several queries (names of Kiwi methods: get_config, get_id,
+        is_logging, get_battery_voltage, read_temperature, read_pressure,
+        read_light) in one go: send all their commands in one write, then
+        parse the responses in order. One round trip instead of one (or
+        three, for get_config on v0) per query. A batch too big for the
+        logger's RX buffer goes out in as few writes as it fits in, each
+        topped up as responses come back.
+
+        Returns the results in the same order."""
+        plans = [self._plan(name) for name in names]
+        todo = deque(cmd for cmds, _ in plans for cmd in cmds)
 
-    def get_sample_count(self):
-        last_page_index = self.find_last_used_page()
+        self._flush()
+
+        def top_up():
+            cmd = b''
+            sent_at = time.time() if 0 == self._flow.outstanding() else None
+            while len(todo) and self._flow.wait(len(todo[0])):
+                self._flow.sent(len(todo[0]))
+                if self.stats is not None:
+                    self.stats.sent(Kiwi._key(todo[0]), len(todo[0]))
+                cmd += todo.popleft()
+            if len(cmd):
+                self._sent_at = sent_at
+                self._ser.write(cmd)
+                self.round_trips += 1
+
+        R = []
+        for cmds, parse in plans:
+            lines = []
+            for cmd in cmds:
+                top_up()
+                lines.append(self._readline(cmd))
+                self._flow.done()
+                logger.debug(lines[-1])
+            R.append(parse(*lines))
+        return R
+
+    def _plan(self, name):
+        """The commands behind a query, and a function that turns their
+        response lines into the result."""
+        if 'get_config' == name:
+            if 0 == self._version:
+                return [b'get_logging_config', b'get_logger_name', b'spi_flash_get_unique_id'], lambda *r: self._keep_config(parse_config_v0(*r))
+            return [b'get_config', b'id'], lambda *r: self._keep_config(parse_config_v1(*r))
+        if 'get_id' == name:
+            if 0 == self._version:
+                return [b'spi_flash_get_unique_id'], parse_id_v0
+            return [b'id'], parse_id_v1
+        if 'is_logging' == name:
+            if 0 == self._version:
+                return [b'is_logging'], parse_is_logging_v0
+            return [b'status'], parse_is_logging_v1
+        if 'get_battery_voltage' == name:
+            if 0 == self._version:
+                return [b'read_sys_volt'], parse_battery_v0
+            return [b'status'], parse_battery_v1
+        if 'read_temperature' == name:
+            return [b'read_temperature' if 0 == self._version else b'T'], lambda r: parse_float(r, 'Deg.C')
+        if 'read_pressure' == name:
+            return [b'read_pressure' if 0 == self._version else b'P'], lambda r: parse_float(r, 'kPa')
+        if 'read_light' == name:
+            if 0 == self._version:
+                return [b'read_ambient_lx', b'read_white_lx', b'read_rgbw'], parse_light_v0
+            return [b'L'], parse_light_v1
+        raise ValueError('{} can\'t be batched'.format(name))
+
+    def _keep_config(self, config):
+        if config is not None:
+            self._config = config
+        return config
+
+    def get_sample_count(self, *_, last_page_index=None, last_page=None):
+        """Pass last_page_index if you already have it from
+        find_last_used_page(), to save searching the flash again, and
+        last_page (that page's content) to save reading it again."""
+        if last_page_index is None:
+            # the search hands back the last page too, saving a read
+            last_page_index, buf = self._find_last_used_page()
+        elif last_page is not None:
+            buf = last_page
+        else:
+            buf = self._read_page_or_fail(last_page_index)
         if last_page_index is None:
             return 0
-        buf = self.read_page(last_page_index)
-        assert not all([0xff == x for x in buf])
-        # I have no idea what I wrote.
-        byte_used = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - next(k for k,v in enumerate(reversed(buf)) if v not in {0, 0xff})
+        if is_erased(buf):
+            # cleared since it was found, or not the last used page at all
+            raise RuntimeError('Page {} is empty'.format(last_page_index))
+        # Everything up to the last programmed byte. A sample can end in 0x00
+        # (light reading < 256) or 0xff (saturated), so don't try to skip
+        # those; round up to a whole sample instead.
+        byte_used = len(bytes(buf).rstrip(b'\xff'))
         # Careful, last_page_index is 0-based. The number of non-empty
         # pages is last_page_index + 1, but here you are summing up the
         # full pages plus the bits in the last (possibly non-full) page.
         # Really it is (last_page_index + 1 - 1).
-        return last_page_index*(Kiwi.SPI_FLASH_PAGE_SIZE_BYTE//self.SAMPLE_SIZE_BYTE) + byte_used//self.SAMPLE_SIZE_BYTE
+        # (a page doesn't divide evenly into samples; the pad at the end
+        # isn't one)
+        return last_page_index*(Kiwi.SPI_FLASH_PAGE_SIZE_BYTE//self.SAMPLE_SIZE_BYTE) + min(math.ceil(byte_used/self.SAMPLE_SIZE_BYTE), self.SAMPLE_PER_PAGE)
         # huh. is A//X + B//X === (A + B)//X? Is the // operator distributive? Can I do
         # (last_page*SPI_FLASH_PAGE_SIZE_BYTE + byte_used)//SAMPLE_SIZE_BYTE?
         # Nope. 7//10 + 3//10 != 10//10
@@ -167,32 +839,208 @@ class Kiwi:
         # You could have just kept the sample_per_page =
         # SPI_FLASH_PAGE_SIZE_BYTE//SAMPLE_SIZE_BYTE line you know.
 
-    def find_last_used_page(self):
+    def predict_last_page(self):
+        """Where the last sample should be, going by the session's start
+        time, sample interval, and its stop time (or now if it hasn't
+        stopped). None if the config doesn't say."""
+        config = self.get_config(use_cached=True)
+        if not config.get('start') or not config.get('interval_ms'):
+            return None
+        # v0 says 0 while logging (or if it stopped abnormally)
+        stop = config.get('stop') or self._clock()
+        sample_count = max(0, (stop - config['start'])/(config['interval_ms']/1000))
+        return min(int(sample_count//self.SAMPLE_PER_PAGE), int(Kiwi.SPI_FLASH_PAGE_COUNT) - 1)
+
+    def find_last_used_page(self, *_, content=False):
+        """Index of the last page with anything in it, or None if the
+        memory is empty. With content=True, (index, content of that page),
+        or (None, None). The number of reads it took is left in
+        self.search_probes."""
+        r = self._find_last_used_page()
+        return r if content else r[0]
+
+    def _read_page_or_fail(self, page):
+        """Content of page, retried if the read fails. A failed read says
+        nothing about whether the page is used, so it must not be taken for
+        either: raises RuntimeError if the page just can't be read."""
+        P = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        buf = self.read_range_repair(page*P, (page + 1)*P - 1, min_size=P)
+        if buf is None:
+            raise RuntimeError('Could not read page {}'.format(page))
+        return buf
+
+    def _find_last_used_page(self):
+        """(index of the last used page, its content), or (None, None).
+
+        Reads a few pages around predict_last_page() first, which is
+        usually all it takes. If the answer isn't among them, takes a few
+        doubling steps away from the guess, then bisects whatever range is
+        left. With no guess at all, that's a bisection of the whole flash,
+        ~16 reads."""
         # in principle you only need to check the first byte. but god
         # knows how the flash layout might change in later versions.
-        is_empty = lambda s: all([0xff == x for x in s])
-
-        def search(begin, end):
-            logger.debug('search({},{})'.format(begin, end))
-            
-            if begin >= end:
-                assert False
-            elif end - begin == 1:
-                #print(is_empty(self.read_page(begin)))
-                #print(is_empty(self.read_page(end)))
-                if not is_empty(self.read_page(begin)):
-                    return begin
+        P = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        page_count = Kiwi.SPI_FLASH_SIZE_BYTE//P
+        self.search_probes = 0
+        # content of the pages read so far
+        seen = {}
+
+        def used(page):
+            if page not in seen:
+                self.search_probes += 1
+                seen[page] = self._read_page_or_fail(page)
+            return not is_erased(seen[page])
+
+        # lo is known used (or -1), hi is known erased (or page_count)
+        lo, hi = -1, page_count
+        guess = self.predict_last_page()
+        if guess is not None:
+            first = max(0, guess - Kiwi.SEARCH_BRACKET)
+            last = min(page_count - 1, guess + Kiwi.SEARCH_BRACKET)
+            self.search_probes += 1
+            # retried like any other probe; if it still fails, the search
+            # just goes without the guess
+            d = self.read_range_repair(first*P, (last + 1)*P - 1, min_size=P)
+            if d is not None:
+                for page in range(first, last + 1):
+                    seen[page] = d[(page - first)*P:(page - first + 1)*P]
+                U = [used(page) for page in range(first, last + 1)]
+                if U[-1]:
+                    lo = last
+                    step = 1
+                    for _ in range(Kiwi.SEARCH_GALLOP):
+                        if lo + step >= hi:
+                            break
+                        if not used(lo + step):
+                            hi = lo + step
+                            break
+                        lo += step
+                        step *= 2
+                elif not U[0]:
+                    hi = first
+                    # most likely the memory has been cleared since
+                    if first > 0 and used(0):
+                        lo = 0
+                        step = 1
+                        for _ in range(Kiwi.SEARCH_GALLOP):
+                            if hi - step <= lo:
+                                break
+                            if used(hi - step):
+                                lo = hi - step
+                                break
+                            hi -= step
+                            step *= 2
+                    else:
+                        hi = 0
                 else:
-                    return None
-            else:
-                mid = int((end + begin)//2)
+                    # it's in the bracket
+                    lo = first + max(i for i, u in enumerate(U) if u)
+                    hi = lo + 1
 
-            if is_empty(self.read_page(mid)):
-                return search(begin, mid)
+        while hi - lo > 1:
+            mid = (lo + hi)//2
+            if used(mid):
+                lo = mid
             else:
-                return search(mid, end)
+                hi = mid
 
-        return search(0, Kiwi.SPI_FLASH_SIZE_BYTE//Kiwi.SPI_FLASH_PAGE_SIZE_BYTE)
+        logger.debug('Last used page: {} ({} probe(s); predicted {})'.format(lo, self.search_probes, guess))
+        if lo < 0:
+            return None, None
+        return lo, seen[lo]
+
+    def enable_stats(self):
+        """Start counting every command sent, unless already counting. Off
+        by default: when off, it costs one check per command. Returns the
+        CommandStats."""
+        if self.stats is None:
+            self.stats = CommandStats()
+        return self.stats
+
+    def enable_page_cache(self, budget=PAGE_CACHE_BYTE):
+        """Keep flash pages in memory once read, so that counting the
+        samples, the memory overview and the download don't each read the
+        same pages again. Every flash read goes through it.
+
+        Only for a logger that isn't logging: pages that are still being
+        written would go stale. start_logging() turns it off (call this
+        again once logging has stopped); stop_logging() and clear_memory()
+        empty it. Returns the PageCache (hits and misses are counted in
+        pages)."""
+        if self.page_cache is None:
+            self.page_cache = PageCache(budget)
+        return self.page_cache
+
+    def enable_page_store(self, *_, root=PAGE_STORE_DIR):
+        """Keep every page read in this logging session on disk (a
+        PageStore in root/ID/ID_START.pages), and read from there first.
+        Unlike the page cache it is fine while logging: only pages the
+        logger has finished writing are kept. start_logging() closes it;
+        clear_memory() deletes it. Returns the PageStore."""
+        fn = self._page_store_name(root)
+        if self.page_store is not None and self.page_store.fn != fn:
+            self._close_page_store()
+        if self.page_store is None:
+            makedirs(dirname(fn), exist_ok=True)
+            self.page_store = PageStore(fn, Kiwi.SPI_FLASH_PAGE_SIZE_BYTE)
+            logger.debug('{} page(s) in {}'.format(len(self.page_store), fn))
+        return self.page_store
+
+    def _page_store_name(self, root=PAGE_STORE_DIR):
+        config = self.get_config(use_cached=True)
+        return join(root, config['id'], '{}_{}.pages'.format(config['id'], config['start']))
+
+    def _close_page_store(self):
+        if self.page_store is not None:
+            self.page_store.close()
+            self.page_store = None
+
+    def _cache_get(self, begin, end):
+        P = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        first = begin//P
+        d = None
+        if self.page_cache is not None:
+            d = self.page_cache.get(first, end//P)
+        if d is None and self.page_store is not None:
+            d = self.page_store.get(first, end//P)
+        if d is None:
+            return None
+        return d[begin - first*P:end - first*P + 1]
+
+    def _cache_runs(self, begin, end):
+        """begin..end split where it goes from pages that are held (in the
+        page cache or the page store) to ones that aren't, or the other way
+        round."""
+        P = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        held = lambda page: any(c is not None and page in c for c in (self.page_cache, self.page_store))
+        runs = []
+        a = begin
+        for page in range(begin//P + 1, end//P + 1):
+            if held(page) != held(page - 1):
+                runs.append((a, page*P - 1))
+                a = page*P
+        runs.append((a, end))
+        return runs
+
+    def _cache_put(self, begin, data):
+        """Keep the whole pages in data (read from begin onwards)."""
+        if self.page_cache is None and self.page_store is None:
+            return
+        P = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+        for page in range(-(-begin//P), (begin + len(data))//P):
+            d = data[page*P - begin:(page + 1)*P - begin]
+            if self.page_cache is not None:
+                self.page_cache.put(page, d)
+            if self.page_store is not None:
+                # samples are written in order, so once the last one in a
+                # page is there, the page won't change again
+                last = (self.SAMPLE_PER_PAGE - 1)*self.SAMPLE_SIZE_BYTE
+                if not is_erased(d[last:last + self.SAMPLE_SIZE_BYTE]):
+                    self.page_store.put(page, d)
+
+    def _cache_clear(self):
+        if self.page_cache is not None:
+            self.page_cache.clear()
 
     def read_page(self, page):
         #return read_range_core(ser, page*SPI_FLASH_PAGE_SIZE_BYTE, (page+1)*SPI_FLASH_PAGE_SIZE_BYTE - 1)
@@ -200,126 +1048,283 @@ class Kiwi:
         end = (page+1)*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1
         return self.read_range_core(begin, end)
 
+    def _read_range_cmd(self, begin, end):
+        if 0 == self._version:
+            cmd = 'spi_flash_read_range{:x},{:x}\n'.format(begin, end)
+        else:
+            cmd = 'read_range{:x},{:x}\n'.format(begin, end)
+        return cmd.encode()
+
     def read_range_core(self, begin, end):
         assert end >= begin
 
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+        cached = self._cache_get(begin, end)
+        if cached is not None:
+            return cached
+
+        self._flush()
 
-        old_timeout = self._ser.timeout
-        self._ser.timeout = 4
-        
         expected_length = end - begin + 1 + 4
         
-        if 0 == self._version:
-            cmd = 'spi_flash_read_range{:x},{:x}\n'.format(begin, end)
-        else:
-            cmd = 'read_range{:x},{:x}\n'.format(begin, end)
-        cmd = cmd.encode()
-        self._ser.write(cmd)
-        line = self._ser.read(expected_length)
-        self._ser.timeout = old_timeout
-        if len(line) != expected_length:
+        cmd = self._read_range_cmd(begin, end)
+        self._write(cmd)
+        self.round_trips += 1
+        line = self._read(cmd, expected_length)
+        self._flow.done()
+        error = check_range_response(line, expected_length)
+        if 'short' == error:
             logger.error('Expecting {}, got {}.'.format(expected_length, len(line)))
             return []
-        if not check_response(line):
+        if 'crc' == error:
             logger.error('CRC failure')
+            if self.stats is not None:
+                self.stats.crc_error(Kiwi._key(cmd))
             return []
 
+        self._cache_put(begin, line[:-4])
         return line[:-4]    # strip CRC32
 
-    def is_empty(self):
+    def _read_range_checked(self, begin, end):
+        """Like read_range_core(), but returns (data, reason). data is None if
+        the read failed, and reason says why ('short' or 'crc'). A response
+        that merely arrives late is still accepted (see _timed())."""
+        cached = self._cache_get(begin, end)
+        if cached is not None:
+            return cached, None
+
+        self._flush()
+
+        expected_length = end - begin + 1 + 4
+
+        cmd = self._read_range_cmd(begin, end)
+        self._write(cmd)
+        self.round_trips += 1
+        line = self._read(cmd, expected_length)
+        self._flow.done()
+
+        error = check_range_response(line, expected_length)
+        if error is not None:
+            if self.stats is not None and 'crc' == error:
+                self.stats.crc_error(Kiwi._key(cmd))
+            self._drain()
+            return None, error
+        self._cache_put(begin, line[:-4])
+        return line[:-4], None
+
+    def read_range_repair(self, begin, end, *_, error_map=None, min_size=SPI_FLASH_PAGE_SIZE_BYTE, max_retry=8):
+        """Read begin..end, repairing rather than repeating failed reads.
+
+        A short response can't be checked (its CRC is the part that went
+        missing), and a CRC failure doesn't say where the damage is. Either
+        way the range is split in half, each half read with its own CRC, and
+        only the half that fails again is split further, until the bad part
+        is down to min_size and simply retried. Good halves are kept.
+
+        Every range that needed repair is appended to error_map (a list) as
+        {'begin', 'end', 'reason'}. Returns the data, or None if a min_size
+        piece still fails after max_retry attempts."""
+        line, reason = self._read_range_checked(begin, end)
+        if reason is not None and error_map is not None:
+            error_map.append({'begin':begin, 'end':end, 'reason':reason})
+        if line is not None:
+            return line
+        return self._repair(begin, end, error_map, min_size, max_retry)
+
+    def _repair(self, begin, end, error_map, min_size, max_retry):
+        size = end - begin + 1
+        if size <= min_size:
+            for _ in range(max_retry):
+                line, reason = self._read_range_checked(begin, end)
+                if line is not None:
+                    return line
+                if error_map is not None:
+                    error_map.append({'begin':begin, 'end':end, 'reason':reason})
+            logger.error('Could not read {:X}-{:X}'.format(begin, end))
+            return None
+
+        # split on a min_size boundary so the pieces stay page-aligned
+        mid = begin + max(1, size//2//min_size)*min_size
+        D = []
+        for a, b in [(begin, mid - 1), (mid, end)]:
+            logger.debug('repair {:X}-{:X}'.format(a, b))
+            line, reason = self._read_range_checked(a, b)
+            if line is None:
+                if error_map is not None:
+                    error_map.append({'begin':a, 'end':b, 'reason':reason})
+                line = self._repair(a, b, error_map, min_size, max_retry)
+                if line is None:
+                    return None
+            D.append(line)
+        return b''.join(D)
+
+    def read_range_pipelined(self, ranges, *_, depth=4):
+        """Read a sequence of (begin, end) ranges, keeping up to depth requests
+        in flight so the link doesn't sit idle between responses.
+
+        Responses come back in the order the requests were sent. Each one is
+        matched to its request by length and CRC. Yields (begin, end, data);
+        data is None if that range failed, in which case everything else in
+        flight is discarded and re-requested, and it is up to the caller to
+        retry the failed range (read_range_core() will do). Why it failed
+        ('short' or 'crc', as in read_range_repair()'s error map) is left in
+        self.pipeline_error.
+
+        ranges is consumed lazily, so it can be a generator.
+
+        To save copying, data is a memoryview into a receive buffer that is
+        reused for the next range: write it out or copy it before asking for
+        the next one.
+
+        With a page cache or page store, a range that is partly held comes
+        back in pieces: the held ones and the ones that had to be read.
+
+        Sustained throughput (byte/s) is left in self.throughput."""
+        ranges = iter(ranges)
+        todo = deque()      # ranges put back after a failure
+        pending = deque()   # (begin, end, data if cached else None), in flight
+        exhausted = False
+
+        self._flush()
+
+        key = Kiwi._key(self._read_range_cmd(0, 0))
+        old_timeout = self._ser.timeout
+
+        self.throughput = None
+        byte_count = 0
+        starttime = time.time()
+        try:
+            while True:
+                # top up the window
+                while len(pending) < depth:
+                    if len(todo):
+                        begin, end = todo.popleft()
+                    elif not exhausted:
+                        try:
+                            begin, end = next(ranges)
+                        except StopIteration:
+                            exhausted = True
+                            continue
+                    else:
+                        break
+                    assert end >= begin
+                    cached = self._cache_get(begin, end)
+                    if cached is not None:
+                        # nothing to ask for, but it still has to wait its turn
+                        pending.append((begin, end, cached))
+                        continue
+                    if self.page_cache is not None or self.page_store is not None:
+                        # only ask for the pages that aren't held
+                        runs = self._cache_runs(begin, end)
+                        if len(runs) > 1:
+                            todo.extendleft(reversed(runs))
+                            continue
+                    cmd = self._read_range_cmd(begin, end)
+                    if len(pending) and not self._flow.fits(len(cmd)):
+                        todo.appendleft((begin, end))
+                        break
+                    self._write(cmd)
+                    self.round_trips += 1
+                    pending.append((begin, end, None))
+
+                if not len(pending):
+                    break
+
+                begin, end, cached = pending.popleft()
+                if cached is not None:
+                    yield begin, end, cached
+                    continue
+                expected_length = end - begin + 1 + 4
+                line = self._receive_buffer(expected_length)
+                self._ser.timeout = self._timer.timeout(key, expected_length,
+                                                        default=1 + 2*expected_length/self._timer.byte_rate)
+                started = time.time()
+                n = self._ser.readinto(line)
+                self._flow.done()
+                if self.stats is not None:
+                    self.stats.received(key, n, time.time() - started)
+                if n != expected_length:
+                    self._timer.timed_out(key)
+                elif self._sent_at is not None:
+                    # it was the only one in flight, so this is a clean sample
+                    self._timer.sample(key, time.time() - self._sent_at, n)
+                self._sent_at = None
+                if n == expected_length and check_response(line):
+                    byte_count += expected_length
+                    self.throughput = byte_count/(time.time() - starttime)
+                    self._cache_put(begin, line[:-4])
+                    yield begin, end, line[:-4]
+                    continue
+
+                if n != expected_length:
+                    logger.error('Expecting {}, got {}.'.format(expected_length, n))
+                    self.pipeline_error = 'short'
+                    if self.stats is not None:
+                        self.stats.timed_out(key)
+                else:
+                    logger.error('CRC failure')
+                    self.pipeline_error = 'crc'
+                    if self.stats is not None:
+                        self.stats.crc_error(key)
+                # Lost track of where one response ends and the next one
+                # begins. Let the firmware finish whatever it was asked to
+                # do, throw it all away, and ask again.
+                self._drain()
+                todo.extendleft(reversed([(b, e) for b, e, _ in pending]))
+                pending.clear()
+                yield begin, end, None
+        finally:
+            if any(cached is None for _, _, cached in pending):
+                self._drain()
+            self._ser.timeout = old_timeout
+            if self.throughput is not None:
+                logger.debug('{:.0f} byte/s'.format(self.throughput))
+
+    def _receive_buffer(self, n):
+        if len(self._rxbuf) < n:
+            # a new one rather than resizing: the caller may still be holding
+            # a view into the old one, which would make resizing fail
+            self._rxbuf = bytearray(n)
+        return memoryview(self._rxbuf)[:n]
+
+    def _drain(self):
+        old_timeout = self._ser.timeout
+        self._ser.timeout = 0.5
+        while len(self._ser.read(4096)):
+            pass
+        self._ser.timeout = old_timeout
         self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+        # it has gone quiet, so it has caught up with everything
+        self._flow.reset()
 
+    def is_empty(self):
         r = self.read_range_core(0, 63)
         if r is None:
             # let the caller deal with that.
             raise RuntimeError
-        return all([0xff == rr for rr in r])
+        return is_erased(r)
 
     # given a sample index, calculate (page address, byte index within that page)
     def sampleindex2flashaddress(self, sample_index):
         return int(sample_index//self.SAMPLE_PER_PAGE), int((sample_index%self.SAMPLE_PER_PAGE)*self.SAMPLE_SIZE_BYTE)
 
-    # given a sample index, time of the first sample, and the sample interval, calculate the sample index
+    # given a time (POSIX timestamp or UTC datetime), calculate the index of
+    # the sample taken at or just before it, using the session's start time
+    # and sample interval. Can be negative, or past the last sample.
     def date2sampleindex(self, ts):
-        ts = dt2ts(ts) if type(ts) is datetime else ts
-        return (ts - config['start'])//(config['interval_ms']/1000)
+        ts = dt2ts(ts) if isinstance(ts, datetime) else ts
+        config = self.get_config(use_cached=True)
+        return int((ts - config['start'])//(config['interval_ms']/1000))
 
     def read_temperature(self):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
-        
-        self._ser.write(b'read_temperature' if 0 == self._version else b'T')
-        r = self._ser.readline()
-        logger.debug(r)
-        try:
-            return float(r.strip().decode().replace('Deg.C', ''))
-        except:
-            logger.exception('')
-            return float('nan')
+        return self.batch(['read_temperature'])[0]
 
     def read_pressure(self):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
-        
-        self._ser.write(b'read_pressure' if 0 == self._version else b'P')
-        r = self._ser.readline()
-        logger.debug(r)
-        try:
-            return float(r.strip().decode().replace('kPa', ''))
-        except:
-            logger.exception('')
-            return float('nan')
-            
+        return self.batch(['read_pressure'])[0]
 
     def read_light(self, *_, as_dict=True):
         """in lx for all"""
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
-
-        d = []
-        if 0 == self._version:
-            self._ser.write(b'read_ambient_lx')
-            r = self._ser.readline()
-            logger.debug(r)
-            d.append(float(r.decode().strip().split(',')[0].replace('lx', '')))
-
-            self._ser.write(b'read_white_lx')
-            r = self._ser.readline()
-            logger.debug(r)
-            d.append(float(r.decode().strip().split(',')[0].replace('lx', '')))
-            
-            self._ser.write(b'read_rgbw')
-            r = self._ser.readline()
-            logger.debug(r)
-            r = [int(float(x)) for x in r.decode().strip().split(',')]
-            d.extend(r)
-
-            return dict(zip(('hdr_als', 'hdr_w', 'r', 'g', 'b', 'w'), d)) if as_dict else d
-        else:
-            self._ser.write(b'L')
-            r = self._ser.readline()
-            logger.debug(r)
-            r = [float(x) for x in r.decode().strip().split(',')]
-
-            '''# raw to lux for VEML6030
-            def c(v):
-                v *= 1.8432
-                if v > 1e3:
-                    v = 6.0135e-13*v*v*v*v - 9.3924e-9*v*v*v + 8.1488e-5*v*v + 1.0023*v;    # >1klx correction
-                return v
-            r[0] = c(r[0])
-            r[1] = c(r[1])
-
-            c = lambda x: 0.25168*x
-            r[2] = c(r[2])
-            r[3] = c(r[3])
-            r[4] = c(r[4])
-            r[5] = c(r[5])'''
-
-            return dict(zip(('hdr_als', 'hdr_w', 'r', 'g', 'b', 'w'), r)) if as_dict else r
+        d = self.batch(['read_light'])[0]
+        return dict(zip(('hdr_als', 'hdr_w', 'r', 'g', 'b', 'w'), d)) if as_dict else d
 
     def get_logging_interval_code(self, interval_ms):
         if 0 == self._version:
@@ -341,44 +1346,100 @@ class Kiwi:
         return M[interval_ms]
 
     def set_logging_interval(self, interval_ms):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+        self._flush()
 
         code = self.get_logging_interval_code(interval_ms)
         logger.debug(code)
-        self._ser.write('set_logging_interval{}\r\n'.format(code).encode('utf-8'))
+        self._write('set_logging_interval{}\r\n'.format(code).encode('utf-8'), response=0 != self._version)
         if 0 != self._version:
-            tmp = 'OK' == self._ser.readline().decode().strip()
+            self.round_trips += 1
+            tmp = 'OK' == self._readline(b'set_logging_interval').decode().strip()
+            self._flow.done()
         else:
             tmp = True
         return tmp and self.get_config(use_cached=False)['interval_ms'] == interval_ms
 
     def start_logging(self):
+        # nothing read from now on stays put
+        self.page_cache = None
+        self._close_page_store()
         if 0 == self._version:
-            self._ser.write(b'start_logging')
+            self._write(b'start_logging', response=False)
         else:
-            self._ser.write(b'rt0')
-            self._ser.readline()  # "OK\r\n"
-            self._ser.write('start_logging{}\n'.format(int(time.time())).encode('utf-8'))
-            self._ser.readline()  # "OK\r\n"
+            self._write(b'rt0')
+            self._readline(b'rt0')  # "OK\r\n"
+            self._flow.done()
+            self._write('start_logging{}\n'.format(int(self._clock())).encode('utf-8'))
+            self._readline(b'start_logging')  # "OK\r\n"
+            self._flow.done()
+            self.round_trips += 2
 
-        time.sleep(0.2)
+        # check back until it says it's logging, rather than waiting a fixed
+        # 0.2 s every time
+        for _ in range(4):
+            if self.is_logging():
+                return True
+            time.sleep(0.05)
         return self.is_logging()
 
     def stop_logging(self):
-        self._ser.reset_input_buffer()
-        self._ser.reset_output_buffer()
+        self._cache_clear()
+        self._flush()
 
-        self._ser.write(b'stop_logging')
+        self._write(b'stop_logging', response=0 != self._version)
         self._ser.flushOutput()
         if 0 != self._version:
             #'OK' == self._ser.readline().decode().strip()
-            self._ser.readline()
+            self.round_trips += 1
+            self._readline(b'stop_logging')
+            self._flow.done()
+
+    def clear_memory(self):
+        """Erase the flash. Prints the logger's progress dots. True if it
+        says it's done."""
+        self._cache_clear()
+        # the session keeps its start time, so its page store would still be
+        # opened (and believed) afterwards, whichever script made it
+        stale = {self._page_store_name()}
+        if self.page_store is not None:
+            stale.add(self.page_store.fn)
+        self._close_page_store()
+        for fn in stale:
+            if exists(fn):
+                remove(fn)
+        self._flush()
+        self._write(b'clear_memory')
+        self.round_trips += 1
+        THRESHOLD = 8
+        cool = THRESHOLD
+        while cool > 0:
+            try:
+                line = self._ser.read(100)
+                logger.debug(line)
+                if not all([ord(b'.') == tmp for tmp in line]):
+                    logger.debug('Not cool')
+                    cool -= 1
+                else:
+                    logger.debug('cool')
+                    cool = THRESHOLD
+
+                print(line.decode(), end='', flush=True)
+                if 'done.' in line.decode():
+                    self._flow.done()
+                    return True
+            except UnicodeDecodeError:
+                pass
+
+        self._drain()
+        return False
 
     def read_rtc(self):
         if 0 == self._version:
-            self._ser.write(b'read_rtc')
-            return float(self._ser.readline().decode().strip())
+            self._write(b'read_rtc')
+            self.round_trips += 1
+            r = self._readline(b'read_rtc')
+            self._flow.done()
+            return float(r.decode().strip())
         else:
             logger.warning('Deprecated')
             return time.time()
@@ -403,11 +1464,13 @@ class Kiwi:
     def set_rtc(self, *_, t=None):
         if 0 == self._version:
             if t is None:
-                t = time.time()
-            self._ser.reset_input_buffer()
-            self._ser.reset_output_buffer()
-            self._ser.write('write_rtc{}\n'.format(math.floor(t)).encode())
-            return self._ser.readline().decode()
+                t = self._clock()
+            self._flush()
+            self._write('write_rtc{}\n'.format(math.floor(t)).encode())
+            self.round_trips += 1
+            r = self._readline(b'write_rtc')
+            self._flow.done()
+            return r.decode()
         else:
             logger.warning('Deprecated')
             return str(int(time.time()))
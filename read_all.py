@@ -0,0 +1,145 @@
+# Download every logger attached to this machine at once (e.g. a powered hub
+# full of recovered loggers), one worker per serial port.
+#
+# Nothing is asked: loggers that are still logging are left alone,
+# incomplete downloads are resumed, finished ones are skipped. Each download
+# is converted to CSV as soon as it's done.
+#
+# MESHLAB, UH Manoa
+import time, logging, sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from serial import Serial
+from serial.serialutil import SerialException
+from kiwi import Kiwi
+from common import serial_port_best_guess2
+from read_memory import read_memory
+from bin2csv import bin2csv
+
+
+# Download from at most this many loggers at a time
+MAX_WORKERS = 8
+# Reprint the progress table every this many seconds
+REFRESH_INTERVAL = 2
+
+
+class Progress:
+    """What the worker for one port is up to."""
+
+    def __init__(self, port):
+        self.port = port
+        self.id = ''
+        self.name = ''
+        self.state = 'waiting'
+        self.byte_done = 0
+        self.byte_total = 0
+        self.retry_count = 0
+        self.rate = None
+        # what read_memory() had to say, shown after the table is done with
+        self.log = []
+        self._start = None
+
+    def echo(self, msg):
+        """Passed to read_memory() to print with."""
+        self.log.append(msg)
+
+    def update(self, byte_done, byte_total, retry_count):
+        """Passed to read_memory() as its progress callback."""
+        now = time.time()
+        if self._start is None:
+            # resumed downloads don't start from 0
+            self._start = (now, byte_done)
+        elif now > self._start[0]:
+            self.rate = (byte_done - self._start[1])/(now - self._start[0])
+        self.byte_done = byte_done
+        self.byte_total = byte_total
+        self.retry_count = retry_count
+
+    def eta(self):
+        if not self.rate:
+            return None
+        return timedelta(seconds=int((self.byte_total - self.byte_done)/self.rate))
+
+
+def download(port, progress):
+    """Download and convert whatever logger is on port. Returns the .bin
+    file name, or None."""
+    progress.state = 'connecting'
+    try:
+        with Serial(port, 115200, timeout=2, exclusive=True) as ser:
+            kiwi = Kiwi(ser)
+            config = kiwi.get_config(use_cached=True)
+            progress.id = config['id']
+            progress.name = config['name']
+            if kiwi.is_logging():
+                progress.state = 'still logging; skipped'
+                return None
+            progress.state = 'reading'
+            fn_bin = read_memory(kiwi, interactive=False, progress=progress.update, echo=progress.echo)
+        if fn_bin is None:
+            progress.state = 'nothing to read'
+            return None
+
+        progress.state = 'converting'
+        bin2csv(fn_bin, fn_bin.rsplit('.', 1)[0] + '.csv', config)
+        progress.state = 'done'
+        return fn_bin
+    except (SerialException, RuntimeError) as e:
+        logging.debug(e)
+        progress.state = 'failed ({})'.format(e)
+    except Exception as e:
+        logging.exception(e)
+        progress.state = 'failed ({})'.format(e)
+    return None
+
+def print_table(P):
+    print('{:<16} {:<16} {:<15} {:>6} {:>10} {:>8} {:>5}  {}'.format(
+        'PORT', 'ID', 'NAME', 'DONE', 'BYTE/S', 'ETA', 'RETRY', 'STATE'))
+    for p in P:
+        print('{:<16} {:<16} {:<15} {:>6} {:>10} {:>8} {:>5}  {}'.format(
+            p.port[-16:],
+            p.id,
+            p.name[:15],
+            '{:.0f}%'.format(100*p.byte_done/p.byte_total) if p.byte_total else '',
+            '{:,.0f}'.format(p.rate) if p.rate else '',
+            str(p.eta() or ''),
+            p.retry_count,
+            p.state))
+    print()
+
+def read_all(ports, *_, max_workers=MAX_WORKERS):
+    P = [Progress(port) for port in ports]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        F = [executor.submit(download, p.port, p) for p in P]
+        try:
+            while not all(f.done() for f in F):
+                print_table(P)
+                time.sleep(REFRESH_INTERVAL)
+        except KeyboardInterrupt:
+            print('User interrupted. Downloads in progress will finish; run this again to resume the rest.')
+            for f in F:
+                f.cancel()
+    print_table(P)
+    for p in P:
+        if len(p.log):
+            print('{}:'.format(p.port))
+            for msg in p.log:
+                print('  ' + msg)
+    return [f.result() for f in F if not f.cancelled()]
+
+
+if '__main__' == __name__:
+
+    logging.basicConfig(level=logging.WARNING)
+
+    ports = serial_port_best_guess2()
+    if not len(ports):
+        print('Didn\'t find a serial port. Terminating.')
+        sys.exit()
+    print('Using {} port(s): {}'.format(len(ports), ', '.join(ports)))
+
+    starttime = time.time()
+    FN = [fn for fn in read_all(ports) if fn is not None]
+    print('{} logger(s) downloaded in {:.1f} minutes.'.format(len(FN), (time.time() - starttime)/60))
+    for fn in FN:
+        print('  ' + fn)
@@ -4,26 +4,35 @@
 # hlio@hawaii.edu
 # MESHLAB, UH Manoa
 import time, logging, sys, json
-from os import makedirs
-from os.path import join, exists
+from contextlib import ExitStack
+from os import makedirs, replace, environ
+from os.path import join, exists, getsize
 from serial import Serial
 from serial.serialutil import SerialException
-from kiwi import Kiwi
+from kiwi import Kiwi, CommandStats
 from common import save_most_recent_id
 from bin2csv import bin2csv
-from datetime import timedelta
+from archive import make_manifest, save_manifest, manifest_name, store
+from datetime import datetime, timedelta
 
 
 # Read memory range (in byte) from here...
 BEGIN = 0
 # ... to here
 END = Kiwi.SPI_FLASH_SIZE_BYTE - 1
-# Request this many bytes per call
+# Request this many bytes per call (to begin with; see ChunkSizeController)
 # The response will be 4-byte longer than requested due to the CRC32 at the
 # end, but that's checked and striped by kiwi.read_range_core().
 CHUNK_SIZE = 32*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
-# Stop reading if the response is all empty (0xff for NOR flash)
-STOP_ON_EMPTY = True
+# Bounds for the adaptive chunk size. A 32 kB response takes ~3 s at 115200
+# baud, which is about as much as the 4 s read timeout allows.
+MIN_CHUNK_SIZE = Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+MAX_CHUNK_SIZE = 128*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+# Read only up to the last sample in the last used page, instead of the
+# whole page. bin2csv() copes with a partial page at the end.
+TRIM_LAST_PAGE = False
+# Keep this many read requests in flight (see Kiwi.read_range_pipelined())
+PIPELINE_DEPTH = 4
 
 
 def split_range(begin, end, pkt_size):
@@ -32,26 +41,189 @@ def split_range(begin, end, pkt_size):
     B = [x + pkt_size - 1 for x in A]
     return list(zip(A, B))
 
-def read_memory(kiwi):
+class ChunkSizeController:
+    """Pick the read_range request size as the download goes.
 
+    Double the size after a run of clean chunks, as long as the byte rate at
+    the new size is not worse than at the old one. Halve it on every short
+    read or CRC failure. A clean link ends up at MAX_CHUNK_SIZE; a noisy one
+    settles where chunks actually make it through."""
+
+    def __init__(self, size=CHUNK_SIZE, *_, min_size=MIN_CHUNK_SIZE, max_size=MAX_CHUNK_SIZE, grow_after=4):
+        self.size = size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.grow_after = grow_after
+        self.success_count = 0
+        self.failure_count = 0
+        self.rate = {}      # size -> byte/s, smoothed
+        self._last = None
+
+    def success(self, begin, end):
+        """Call once per verified chunk, in the order they arrive."""
+        now = time.time()
+        if self._last is not None and now > self._last:
+            r = (end - begin + 1)/(now - self._last)
+            size = end - begin + 1
+            self.rate[size] = r if size not in self.rate else 0.7*self.rate[size] + 0.3*r
+            logging.info('{:X}-{:X}: {:,} byte chunk, {:,.0f} byte/s'.format(begin, end, size, r))
+        self._last = now
+
+        self.success_count += 1
+        if self.success_count >= self.grow_after and self.size < self.max_size:
+            smaller = self.rate.get(self.size//2)
+            if smaller is None or self.rate.get(self.size, 0) >= 0.9*smaller:
+                self.size = min(2*self.size, self.max_size)
+                logging.info('Chunk size -> {:,} byte'.format(self.size))
+            self.success_count = 0
+
+    def failure(self):
+        self.failure_count += 1
+        self.success_count = 0
+        self._last = None
+        if self.size > self.min_size:
+            self.size = max(self.size//2, self.min_size)
+            logging.info('Chunk size -> {:,} byte'.format(self.size))
+
+    def plan(self, begin, end):
+        """(begin, end) ranges covering begin..end, each sized when it is
+        asked for."""
+        while begin <= end:
+            stop = min(begin + self.size - 1, end)
+            yield begin, stop
+            begin = stop + 1
+
+def load_checkpoint(fn):
+    """Verified chunks recorded so far, as a list of [begin, end]."""
+    try:
+        return json.load(open(fn))
+    except (OSError, ValueError):
+        logging.debug('No usable checkpoint in {}'.format(fn))
+        return None
+
+def save_checkpoint(fn, checkpoint):
+    # write-then-rename so a crash never leaves a half-written checkpoint
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f, separators=(',', ':'))
+    replace(tmp, fn)
+
+def add_chunk(chunks, begin, end):
+    """Record [begin, end] as verified, merging it with its neighbor."""
+    if len(chunks) and chunks[-1][1] + 1 == begin:
+        chunks[-1][1] = end
+    else:
+        chunks.append([begin, end])
+        chunks.sort()
+
+def first_missing(chunks, begin):
+    """First address at or after begin not covered by a verified chunk."""
+    for a, b in chunks:
+        if a <= begin <= b:
+            begin = b + 1
+    return begin
+
+def find_append_point(kiwi, fn_bin):
+    """Where to continue an earlier download of a session that is still
+    being logged: the start of the last page in fn_bin, since that page may
+    have gained samples since. Returns None if that page no longer matches
+    the logger's (different session, or the file is damaged)."""
+    size = getsize(fn_bin)
+    if 0 == size:
+        return BEGIN
+    offset = (size - 1)//Kiwi.SPI_FLASH_PAGE_SIZE_BYTE*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+    with open(fn_bin, 'rb') as fin:
+        fin.seek(offset)
+        old = fin.read()
+    new = kiwi.read_range_repair(BEGIN + offset, BEGIN + offset + Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1)
+    if new is None:
+        return None
+    # NOR flash only ever clears bits when it's written, so bytes that were
+    # erased (0xff) last time may have filled in since. Nothing else may
+    # differ.
+    if not all(a == b or 0xff == a for a, b in zip(old, new)):
+        return None
+    return BEGIN + offset
+
+def reconnect(kiwi, *_, timeout=60):
+    """Reopen the port kiwi was using after it went away (USB glitch,
+    re-enumeration) and re-identify the logger. Returns the new Kiwi, or None
+    if the port didn't come back in time. The new Kiwi owns the new port:
+    close it when done."""
+    old = kiwi._ser
+    port = old.port
+    settings = {'baudrate':old.baudrate, 'timeout':old.timeout, 'exclusive':getattr(old, 'exclusive', None)}
+    try:
+        old.close()
+    except Exception as e:
+        logging.debug(e)
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(1)
+        try:
+            ser = Serial(port, **settings)
+        except SerialException:
+            continue
+        try:
+            new = Kiwi(ser, stats=kiwi.stats)
+        except Exception as e:
+            logging.debug(e)
+            ser.close()
+            continue
+        # the pages already read are still good
+        new.page_cache = kiwi.page_cache
+        new.page_store = kiwi.page_store
+        return new
+    return None
+
+def read_memory(kiwi, *_, resume=None, trim=TRIM_LAST_PAGE, incremental=False, interactive=True, progress=None, echo=print):
+    """Download the logger's memory into data/{id}/{id}_{start}.bin, with
+    its manifest next to it (see archive.py).
+
+    With incremental=True, append to an existing download of the same
+    session instead: only the pages written since last time are read. This
+    is meant for a logger that is still logging, and it doesn't stop it.
+
+    With interactive=False nothing is asked: a low battery is only a
+    warning, an incomplete download is resumed (unless resume=False), and
+    a complete one is left alone.
+
+    If given, progress(byte_done, byte_total, retry_count) is called after
+    every chunk instead of printing a line for it. Everything else it has
+    to say goes to echo (print by default)."""
     config = kiwi.get_config(use_cached=True)
+    # pages already read by anything (the overview, an earlier download)
+    # aren't read again
+    kiwi.enable_page_store()
 
-    print('Name: {}'.format(config['name']))
-    print('ID: {}'.format(config['id']))
-    print('Sample interval = {:.3f} second'.format(config['interval_ms']*1e-3))
-    last_used_page = kiwi.find_last_used_page()
+    echo('Name: {}'.format(config['name']))
+    echo('ID: {}'.format(config['id']))
+    echo('Sample interval = {:.3f} second'.format(config['interval_ms']*1e-3))
+    last_used_page, last_page = kiwi.find_last_used_page(content=True)
     used_page_count = last_used_page + 1 if last_used_page is not None else 0
     if 0 == used_page_count:
-        print('Logger is empty.')
+        echo('Logger is empty.')
         return None
-    print('{:,} samples (~{:.0f}% full)'.format(kiwi.get_sample_count(),
-                                              100*used_page_count/Kiwi.SPI_FLASH_PAGE_COUNT))
+    sample_count = kiwi.get_sample_count(last_page_index=last_used_page, last_page=last_page)
+    echo('{:,} samples (~{:.0f}% full)'.format(sample_count,
+                                             100*used_page_count/Kiwi.SPI_FLASH_PAGE_COUNT))
+
+    # Read exactly as far as there is data, not until an empty chunk shows up.
+    if trim:
+        last = BEGIN + (sample_count//kiwi.SAMPLE_PER_PAGE)*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE \
+               + (sample_count%kiwi.SAMPLE_PER_PAGE)*kiwi.SAMPLE_SIZE_BYTE - 1
+    else:
+        last = BEGIN + used_page_count*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1
+    last = min(last, END)
 
     tmp = kiwi.get_battery_voltage()
-    if tmp < 1.1:
+    if tmp < 1.1 and not interactive:
+        echo('Battery voltage is rather low ({:.1f} V).'.format(tmp))
+    elif tmp < 1.1:
         r = input('Battery voltage is rather low ({:.1f} V). Proceed regardless? (yes/no; default=yes)'.format(tmp))
         if r.strip().lower() in ['no', 'n']:
-            print('No change was made.')
+            echo('No change was made.')
             return None
 
     makedirs(join('data', config['id']), exist_ok=True)
@@ -65,51 +237,180 @@ def read_memory(kiwi):
     open(configfilename, 'w').write(json.dumps(config, separators=(',', ':')))
 
     fn_bin = join('data', config['id'], '{}_{}.bin'.format(config['id'], config['start']))
-    if exists(fn_bin):
+    fn_checkpoint = join('data', config['id'], '{}_{}.checkpoint'.format(config['id'], config['start']))
+    checkpoint = load_checkpoint(fn_checkpoint) if exists(fn_bin) else None
+    if incremental and exists(fn_bin):
+        addr = find_append_point(kiwi, fn_bin)
+        if addr is None:
+            echo(fn_bin + ' does not match what is in the logger. No change was made.')
+            return None
+        echo('Appending to {} from {:X}.'.format(fn_bin, addr))
+        checkpoint = checkpoint or {'errors': []}
+        checkpoint['chunks'] = [[BEGIN, addr - 1]] if addr > BEGIN else []
+        checkpoint['complete'] = False
+    elif checkpoint is not None and not checkpoint.get('complete', False):
+        if resume is None and not interactive:
+            resume = True
+        elif resume is None:
+            r = input(fn_bin + ' is incomplete. Resume? (yes/no; default=yes)')
+            resume = r.strip().lower() in ['', 'yes', 'y']
+        if not resume:
+            checkpoint = None
+    elif exists(fn_bin) and not interactive:
+        echo(fn_bin + ' already exists. No change was made.')
+        return fn_bin
+    elif exists(fn_bin):
         r = input(fn_bin + ' already exists. Overwrite? (yes/no; default=no)')
         if r.strip().lower() != 'yes':
-            print('No change was made.')
+            echo('No change was made.')
             return None
+        checkpoint = None
 
-    starttime = time.time()
-    should_continue = True
-    with open(fn_bin, 'wb') as fout:
-        for begin, end in split_range(BEGIN, END, CHUNK_SIZE):
-            #print('Reading {:X} to {:X} ({:.2f}%; {:.2f}% of total capacity; time elapse: {})'.\
-            print('Reading {:X} to {:X} (~{:.2f}%; time elapsed: {})'.\
-                  format(begin,
-                         end,
-                         100*(end//Kiwi.SPI_FLASH_PAGE_SIZE_BYTE)/Kiwi.SPI_FLASH_PAGE_COUNT,
-                         #end/Kiwi.SPI_FLASH_SIZE_BYTE*100,
-                         timedelta(seconds=int(time.time() - starttime))))
-            for _ in range(16):
-                try:
-                    line = kiwi.read_range_core(begin, end)
-                    if line is not None:
-                        break
-                except KeyboardInterrupt:
-                    print('User interrupted.')
-                    should_continue = False
-                    break
-                except:
-                    logging.warning('read_range_core() failed')
+    if checkpoint is None:
+        checkpoint = {'chunks': [], 'errors': [], 'complete': False}
+        open(fn_bin, 'wb').close()
+    addr = first_missing(checkpoint['chunks'], BEGIN)
+    if addr > BEGIN and not incremental:
+        echo('Resuming from {:X}.'.format(addr))
+    # anything past the first gap has to be read again anyway
+    checkpoint['chunks'] = [c for c in checkpoint['chunks'] if c[1] < addr]
+    checkpoint.setdefault('errors', [])
 
-            if not should_continue:
-                break
+    starttime = time.time()
+    byte_count = 0
+    # start from what dev/comm_link_stress_test.py found works best, if it
+    # was run for this firmware
+    profile = kiwi.link_profile()
+    depth = profile.get('pipeline_depth', PIPELINE_DEPTH)
+    controller = ChunkSizeController(profile.get('chunk_size', CHUNK_SIZE))
+    # reopened: ports reconnect() opens, closed once done with
+    with ExitStack() as reopened, open(fn_bin, 'r+b') as fout:
+        # size the file up front, and trim it back to what was actually
+        # verified at the end
+        fout.truncate(last - BEGIN + 1)
+        fout.seek(addr - BEGIN)
+        while not checkpoint['complete']:
+            try:
+                for begin, end, line in kiwi.read_range_pipelined(controller.plan(addr, last), depth=depth):
+                    #print('Reading {:X} to {:X} ({:.2f}%; {:.2f}% of total capacity; time elapse: {})'.\
+                    if progress is None:
+                        echo('Reading {:X} to {:X} (~{:.2f}%; time elapsed: {})'.\
+                             format(begin,
+                                    end,
+                                    100*(end - BEGIN + 1)/(last - BEGIN + 1),
+                                    #end/Kiwi.SPI_FLASH_SIZE_BYTE*100,
+                                    timedelta(seconds=int(time.time() - starttime))))
+                    if line is None:
+                        # pipeline lost this one. repair it, one request at a time.
+                        controller.failure()
+                        checkpoint['errors'].append({'begin':begin, 'end':end, 'reason':kiwi.pipeline_error})
+                        line = kiwi.read_range_repair(begin, end, error_map=checkpoint['errors'])
+                        if line is None:
+                            echo('Error reading logger memory. Stopped reading.')
+                            break
+                    else:
+                        controller.success(begin, end)
 
-            if line is None:
-                print('Error reading logger memory. Stopped reading.')
+                    fout.write(line)
+                    fout.flush()
+                    byte_count += len(line)
+                    add_chunk(checkpoint['chunks'], begin, end)
+                    save_checkpoint(fn_checkpoint, checkpoint)
+                    addr = end + 1
+                    if progress is not None:
+                        progress(addr - BEGIN, last - BEGIN + 1, controller.failure_count)
+                else:
+                    checkpoint['complete'] = True
                 break
-                
-            if STOP_ON_EMPTY and all([0xFF == b for b in line]):
-                print('Reached empty section in memory.')
+            except KeyboardInterrupt:
+                echo('User interrupted. Run this again to resume.')
                 break
-            fout.write(line)
-            fout.flush()
+            except SerialException as e:
+                logging.warning(e)
+                echo('Lost connection to logger at {:X}. Reconnecting...'.format(addr))
+                kiwi = reconnect(kiwi)
+                if kiwi is None:
+                    echo('Logger did not come back. Run this again to resume.')
+                    break
+                reopened.callback(kiwi._ser.close)
+                tmp = kiwi.get_config(use_cached=True)
+                if (tmp['id'], tmp['start']) != (config['id'], config['start']):
+                    echo('That is a different logger or session (ID={}). Stopped reading.'.format(tmp['id']))
+                    break
+        fout.truncate(addr - BEGIN)
+        save_checkpoint(fn_checkpoint, checkpoint)
     endtime = time.time()
-    print('Took {:.1f} minutes.'.format((endtime - starttime)/60))
+    if addr > BEGIN:
+        # record what was verified, chunk by chunk, and keep a copy of the
+        # image in the archive once it's complete
+        manifest = make_manifest(fn_bin, verified=[[a - BEGIN, b - BEGIN] for a, b in checkpoint['chunks']])
+        save_manifest(manifest_name(fn_bin), manifest)
+        if checkpoint['complete']:
+            n, added = store(fn_bin, manifest)
+            echo('Archived ({} of {} chunk(s) new, {:,} byte).'.format(n, len(manifest['chunks']), added))
+    if len(checkpoint['errors']):
+        echo('{} range(s) needed repair; see {}'.format(len(checkpoint['errors']), fn_checkpoint))
+    echo('Took {:.1f} minutes ({:,.0f} byte/s).'.format((endtime - starttime)/60,
+                                                        byte_count/max(endtime - starttime, 1e-3)))
     return fn_bin
 
+def read_time_window(kiwi, t0, t1):
+    """Download only the pages holding samples taken between t0 and t1 (UTC
+    datetime or POSIX timestamp) into data/{id}/{id}_{start}_{offset}.bin.
+
+    The file starts at the first sample of a page; its .config records that
+    sample's index as sample_offset, which bin2csv() uses to get the
+    timestamps right."""
+    config = kiwi.get_config(use_cached=True)
+    kiwi.enable_page_store()
+
+    i0 = max(0, kiwi.date2sampleindex(t0))
+    i1 = kiwi.date2sampleindex(t1)
+    p0, _ = kiwi.sampleindex2flashaddress(i0)
+    p1, _ = kiwi.sampleindex2flashaddress(i1)
+    # a window that runs past the last sample ends there, not at the end of
+    # the flash (usually one read, see Kiwi.find_last_used_page())
+    last_used_page = kiwi.find_last_used_page()
+    if last_used_page is not None:
+        p1 = min(p1, last_used_page)
+    if i1 < i0 or last_used_page is None or p0 > p1:
+        print('No sample in that time window.')
+        return None
+    begin = BEGIN + p0*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+    end = BEGIN + (p1 + 1)*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE - 1
+    offset = p0*kiwi.SAMPLE_PER_PAGE
+    print('Reading samples {:,} to {:,} ({:X} to {:X})'.format(offset, (p1 + 1)*kiwi.SAMPLE_PER_PAGE - 1, begin, end))
+
+    makedirs(join('data', config['id']), exist_ok=True)
+    fn = join('data', config['id'], '{}_{}_{}'.format(config['id'], config['start'], offset))
+
+    starttime = time.time()
+    # a short window goes in one request
+    controller = ChunkSizeController(min(end - begin + 1, MAX_CHUNK_SIZE))
+    errors = []
+    with open(fn + '.bin', 'wb') as fout:
+        for a, b, line in kiwi.read_range_pipelined(controller.plan(begin, end), depth=PIPELINE_DEPTH):
+            if line is None:
+                controller.failure()
+                errors.append({'begin':a, 'end':b, 'reason':kiwi.pipeline_error})
+                line = kiwi.read_range_repair(a, b, error_map=errors)
+                if line is None:
+                    print('Error reading logger memory. Stopped reading.')
+                    break
+            else:
+                controller.success(a, b)
+            fout.write(line)
+
+    tmp = dict(config)
+    tmp['sample_offset'] = offset
+    open(fn + '.config', 'w').write(json.dumps(tmp, separators=(',', ':')))
+    if len(errors):
+        print('{} range(s) needed repair:'.format(len(errors)))
+        for e in errors:
+            print('  {:X}-{:X} ({})'.format(e['begin'], e['end'], e['reason']))
+    print('Took {:.1f} seconds.'.format(time.time() - starttime))
+    return fn + '.bin'
+
 
 if '__main__' == __name__:
 
@@ -125,25 +426,48 @@ if '__main__' == __name__:
     if '' == PORT:
         PORT = DEFAULT_PORT
 
-    with Serial(PORT, 115200, timeout=2) as ser:
+    # with KIWI_STATS=<file name>, what every command cost goes there at the
+    # end (Prometheus text if it ends in .prom, JSON otherwise)
+    STATS_FILE = environ.get('KIWI_STATS')
+    stats = CommandStats() if STATS_FILE else None
+
+    # locked, so discover.py and the gateway keep off it while it's read
+    with Serial(PORT, 115200, timeout=2, exclusive=True) as ser:
 
         save_default_port(PORT)
 
-        kiwi = Kiwi(ser)
+        kiwi = Kiwi(ser, stats=stats)
 
+        incremental = False
         if kiwi.is_logging():
-            r = input('Logger is still logging. Stop logging? (yes/no; default=no)')
-            if r.strip().lower() == 'yes':
+            r = input('Logger is still logging. Stop logging, or append new data to the last download while it keeps logging? (stop/append/no; default=no)')
+            if r.strip().lower() in ['yes', 'stop']:
                 kiwi.stop_logging()
                 if kiwi.is_logging():
                     print('Could not stop logger. ABORT.')
                     sys.exit()
+            elif r.strip().lower() == 'append':
+                incremental = True
             else:
                 print('No change made. ABORT.')
                 sys.exit()
 
         config = kiwi.get_config(use_cached=True)
-        fn_bin = read_memory(kiwi)
+        r = input('Read only a time window? Enter "begin end" in UTC (e.g. 2019-06-01T00:00 2019-06-02T12:00), or nothing for everything:').strip()
+        if len(r):
+            t0, t1 = [datetime.strptime(t, '%Y-%m-%dT%H:%M') for t in r.split()]
+            fn_bin = read_time_window(kiwi, t0, t1)
+            if fn_bin is not None:
+                config = json.load(open(fn_bin.rsplit('.', 1)[0] + '.config'))
+        else:
+            fn_bin = read_memory(kiwi, incremental=incremental)
+
+    if stats is not None:
+        stats.save(STATS_FILE)
+
+    # nothing was read (empty window, empty logger, or left alone)
+    if fn_bin is None:
+        sys.exit()
 
     # - - - - -
     fn_csv = fn_bin.rsplit('.')[0] + '.csv'
@@ -0,0 +1,127 @@
+# Share one logger connection between several users (a live sensor plot, a
+# battery monitor, a background download...).
+#
+# Kiwi assumes it owns the serial port: most methods start by flushing the
+# buffers, so two overlapping calls corrupt each other's responses. A
+# KiwiScheduler runs every call on one worker thread, one at a time, in
+# priority order. Bulk reads are broken up into chunks that are queued
+# separately, so an interactive request only ever waits for the chunk in
+# progress, not for the whole download.
+#
+#   scheduler = KiwiScheduler(Kiwi(ser))
+#   t = scheduler.interactive.read_temperature()
+#   threading.Thread(target=read_memory, args=(scheduler.bulk,)).start()
+#
+# MESHLAB, UH Manoa
+import itertools, logging, queue, threading
+from concurrent.futures import Future
+from kiwi import Kiwi
+
+
+logger = logging.getLogger(__name__)
+
+
+# Lower goes first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+# Size of the pieces bulk reads are broken into. Also the longest an
+# interactive request waits behind a download: ~0.4 s at 115200 baud.
+BULK_CHUNK_SIZE = 16*Kiwi.SPI_FLASH_PAGE_SIZE_BYTE
+
+
+class KiwiScheduler:
+
+    def __init__(self, kiwi):
+        self._kiwi = kiwi
+        self._queue = queue.PriorityQueue()
+        # ties go in submission order
+        self._counter = itertools.count()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+        self.interactive = _Proxy(self, INTERACTIVE)
+        self.normal = _Proxy(self, NORMAL)
+        self.bulk = _Proxy(self, BULK)
+
+    def _run(self):
+        while True:
+            _, _, future, fn, args, kwargs = self._queue.get()
+            if fn is None:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, priority, name, *args, **kwargs):
+        """Queue kiwi.name(*args, **kwargs). Returns a Future."""
+        future = Future()
+        with self._close_lock:
+            if self._closed:
+                # nothing would ever run it
+                future.set_exception(RuntimeError('Scheduler is closed'))
+            else:
+                self._queue.put((priority, next(self._counter), future, getattr(self._kiwi, name), args, kwargs))
+        return future
+
+    def call(self, name, *args, priority=NORMAL, **kwargs):
+        """kiwi.name(*args, **kwargs), when its turn comes."""
+        return self.submit(priority, name, *args, **kwargs).result()
+
+    def read_range(self, begin, end, *_, priority=BULK, chunk_size=BULK_CHUNK_SIZE):
+        """Read begin..end in chunk_size requests, each queued on its own.
+        Returns the data, or [] if any chunk failed (like read_range_core())."""
+        F = [self.submit(priority, 'read_range_core', a, min(a + chunk_size - 1, end))
+             for a in range(begin, end + 1, chunk_size)]
+        try:
+            D = [f.result() for f in F]
+        finally:
+            for f in F:
+                f.cancel()
+        if not all(len(d) for d in D):
+            return []
+        return b''.join(D)
+
+    def read_range_pipelined(self, ranges, *_, priority=BULK, **__):
+        """Same interface as Kiwi.read_range_pipelined(), so read_memory()
+        runs as is, but through read_range() instead. That gives up
+        pipelining so that every chunk boundary is a chance for someone else
+        to go."""
+        for begin, end in ranges:
+            line = self.read_range(begin, end, priority=priority)
+            yield begin, end, line if len(line) else None
+
+    def close(self):
+        """Stop the worker once everything already queued is done. Anything
+        submitted after that fails with RuntimeError."""
+        with self._close_lock:
+            if not self._closed:
+                self._closed = True
+                self._queue.put((BULK + 1, next(self._counter), None, None, None, None))
+        self._thread.join()
+
+
+class _Proxy:
+    """Looks like the Kiwi, but every method call goes through the
+    scheduler at one priority."""
+
+    def __init__(self, scheduler, priority):
+        self._scheduler = scheduler
+        self._priority = priority
+
+    def read_range_pipelined(self, ranges, **kwargs):
+        return self._scheduler.read_range_pipelined(ranges, priority=self._priority)
+
+    def __getattr__(self, name):
+        v = getattr(self._scheduler._kiwi, name)
+        if not callable(v):
+            return v
+        def f(*args, **kwargs):
+            return self._scheduler.call(name, *args, priority=self._priority, **kwargs)
+        return f
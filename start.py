@@ -1,8 +1,8 @@
-from kiwi import Kiwi
+from kiwi import Kiwi, CommandStats
 from common import serial_port_best_guess2, save_default_port, ts2dt, save_most_recent_id
-import serial, time, logging, sys, json, random
+import serial, time, logging, sys, json, random, os
 from birdseye import birdseye_read, birdseye_plot
-from start_logging import select_interval, clear_memory
+from start_logging import select_interval
 from read_memory import read_memory
 from bin2csv import bin2csv
 
@@ -13,6 +13,10 @@ if '__main__' == __name__:
     logging.getLogger('kiwi').setLevel(logging.INFO)
 
     USE_UTC = False
+    # with KIWI_STATS=<file name>, what every command cost so far goes there
+    # after every step (Prometheus text if it ends in .prom, JSON otherwise)
+    STATS_FILE = os.environ.get('KIWI_STATS')
+    stats = CommandStats() if STATS_FILE else None
 
     while True:
         try:
@@ -45,32 +49,45 @@ if '__main__' == __name__:
                 if random.random() > 0.8:
                     print('Looking for a logger...')
                 
-                kiwi = Kiwi(ser)
+                kiwi = Kiwi(ser, stats=stats)
                 config = kiwi.get_config(use_cached=True)
-                is_logging = kiwi.is_logging()
+                is_logging, vbatt = kiwi.batch(['is_logging', 'get_battery_voltage'])
 
                 print('Found "{}" (ID={}); battery: {:.1f} V; {}.'.format(config['name'],
                                                                          config['id'],
-                                                                         kiwi.get_battery_voltage(),
+                                                                         vbatt,
                                                                          'LOGGING' if is_logging else 'not logging',
                                                                          ))
+                logging.info('{} round trip(s) to the logger'.format(kiwi.round_trips))
 
                 if is_logging:
                     r = input("""
 What would you like to do?
     1. See configuration
     2. Stop logging (!)
+    3. Read new data to file (logger keeps logging)
 Your choice:
 """).strip()
                     if '1' == r:
                         for k in config:
                             print('{}={}'.format(k,  config[k]))
+                    elif '3' == r:
+                        fn_bin = read_memory(kiwi, incremental=True)
+                        if fn_bin is not None:
+                            fn_csv = fn_bin.rsplit('.')[0] + '.csv'
+                            bin2csv(fn_bin, fn_csv, config)
+                            save_most_recent_id(config['id'])
+                            print('Output CSV file: {}'.format(fn_csv))
+                            print('Output binary file: {}'.format(fn_bin))
                     elif '2' == r:
                         r = input("""Type "stop" then hit RETURN to confirm:""").strip().lower().replace('"', '')
                         if r == 'stop':
                             kiwi.stop_logging()
 
                 else:   # not logging
+                    # nothing is being written, so flash pages can be kept
+                    # between the overview, the count and the download
+                    kiwi.enable_page_cache()
                     r = input("""
 What would you like to do?
     1. See configuration
@@ -133,7 +150,7 @@ Your choice:
                     elif '6' == r:
                         r = input('Type "clear" to confirm:')
                         if 'clear' == r.strip().replace('"', '').lower():
-                            clear_memory(ser)
+                            kiwi.clear_memory()
                         else:
                             print('No change was made.')
 
@@ -168,3 +185,6 @@ Your choice:
                 logging.exception(e)
                 #raise
                 time.sleep(1)
+            finally:
+                if stats is not None:
+                    stats.save(STATS_FILE)
@@ -99,31 +99,6 @@ def select_interval(kiwi, use_light_sensors):
     return logging_interval_code
 
 
-def clear_memory(ser):
-    ser.write(b'clear_memory')
-    THRESHOLD = 8
-    cool = THRESHOLD
-    while cool > 0:
-        try:
-            line = ser.read(100)
-            logging.debug(line)
-            if not all([ord(b'.') == tmp for tmp in line]):
-                logging.debug('Not cool')
-                cool -= 1
-            else:
-                logging.debug('cool')
-                cool = THRESHOLD
-
-            print(line.decode(), end='', flush=True)
-            if 'done.' in line.decode():
-                return True
-        except UnicodeDecodeError:
-            pass
-
-    if cool <= 0:
-        return False
-
-
 if '__main__' == __name__:
 
     # find the serial port to use from user, from history, or make a guess
@@ -223,7 +198,7 @@ if '__main__' == __name__:
                     break
             if r in ['yes']:
                 logging.debug('User wants to wipe memory.')
-                if not clear_memory(ser):
+                if not kiwi.clear_memory():
                     print('Logger is not responding to clear_memory. ABORT.')
                     sys.exit()
             else: